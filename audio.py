@@ -0,0 +1,529 @@
+import os
+import audioop
+import threading
+import subprocess
+import collections
+
+import discord
+import numpy as np
+
+FRAME_DURATION = discord.opus.Encoder.FRAME_LENGTH / 1000  # 20 мс
+PCM_FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE  # Байт PCM в одном кадре (s16le, 48 кГц, стерео)
+
+
+class GrowingFile:
+    """Файл, который yt-dlp ещё докачивает.
+
+    Файл открывается при первом событии прогресса загрузки, поэтому последующие
+    переименования (.part -> итоговое имя -> папка кэша) чтению не мешают (POSIX).
+    Читать его можно несколькими независимыми читателями (см. reader()); у каждого
+    свой дескриптор, а общий закрывается, как только загрузка завершена.
+    """
+    def __init__(self):
+        self.file = None
+        self.done = False
+        self.failed = False
+        self.readers = set()  # Читатели с открытыми дескрипторами
+        self.condition = threading.Condition()
+
+    def on_progress(self, status):
+        """Хук прогресса yt-dlp (вызывается из потока загрузки)."""
+        with self.condition:
+            if self.file is None and not self.done:
+                path = status.get('tmpfilename') or status.get('filename')
+                try:
+                    self.file = open(path, 'rb')
+                except (OSError, TypeError):
+                    pass  # Файл ещё не создан, попробуем на следующем событии
+            self.condition.notify_all()
+
+    def is_open(self):
+        return self.file is not None
+
+    def finish(self, failed=False):
+        """Загрузка завершена (или прервана): читатели дочитывают остаток и получают конец файла.
+
+        Новые читатели после этого не нужны: файл уже лежит в кэше.
+        """
+        with self.condition:
+            self.done = True
+            self.failed = failed
+            self.close_file()
+            self.condition.notify_all()
+
+    def reader(self):
+        """Новый читатель с начала файла (например, для повторного запуска FFmpeg)."""
+        reader = GrowingFileReader(self)
+        with self.condition:
+            self.attach(reader)
+        return reader
+
+    def attach(self, reader):
+        """Открывает читателю собственный дескриптор, если файл уже открыт (вызывается под condition)."""
+        if reader.fd is None and not reader.closed and self.file is not None:
+            reader.fd = os.dup(self.file.fileno())
+            self.readers.add(reader)
+
+    def read_at(self, reader, offset, size):
+        """Читает данные с позиции offset, дожидаясь их, пока загрузка не завершена."""
+        with self.condition:
+            while True:
+                if reader.closed:
+                    return b''
+                self.attach(reader)
+                if reader.fd is not None:
+                    data = os.pread(reader.fd, size, offset)
+                    if data or self.done:
+                        return data
+                elif self.done:
+                    return b''
+                self.condition.wait(0.5)
+
+    def release(self, reader):
+        """Закрывает дескриптор читателя."""
+        with self.condition:
+            reader.closed = True
+            if reader.fd is not None:
+                os.close(reader.fd)
+                reader.fd = None
+            self.readers.discard(reader)
+            self.condition.notify_all()
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        with self.condition:
+            self.close_file()
+            self.done = True
+            for reader in list(self.readers):
+                self.release(reader)
+            self.condition.notify_all()
+
+
+class GrowingFileReader:
+    """Файлоподобный объект для FFmpeg (pipe=True), читающий GrowingFile со своей позиции.
+
+    Когда чтение догоняет загрузку, read() ждёт новых данных. FFmpeg при этом читает
+    не быстрее, чем Discord забирает кадры, — так воспроизведение и загрузка связаны
+    обратным давлением. Дескриптор читателя закрывается в конце файла или при close().
+    """
+    def __init__(self, growing):
+        self.growing = growing
+        self.offset = 0
+        self.fd = None
+        self.closed = False
+
+    def read(self, size=-1):
+        data = self.growing.read_at(self, self.offset, size if size > 0 else 65536)
+        self.offset += len(data)
+        if not data:
+            self.close()
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.growing.release(self)
+
+
+class PipedSource(discord.AudioSource):
+    """Источник FFmpeg, читающий GrowingFileReader через stdin: вместе с ним закрывает и читателя."""
+    def __init__(self, source, reader):
+        self.source = source
+        self.reader = reader
+
+    def read(self):
+        return self.source.read()
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+        self.reader.close()
+
+
+class OpusFramesSource(discord.AudioSource):
+    """Источник из Opus-пакетов в памяти (oggopus.OpusFrames): без FFmpeg и без перекодирования."""
+    def __init__(self, frames):
+        self.frames = frames
+        self.position = 0
+
+    def read(self):
+        if self.position >= len(self.frames):
+            return b''
+        packet = self.frames.packet(self.position)
+        self.position += 1
+        return packet
+
+    def is_opus(self):
+        return True
+
+
+class PacketFileSource(OpusFramesSource):
+    """Источник из файла пакетов (oggopus.PacketFile): пакеты читаются из mmap без копирования."""
+    def cleanup(self):
+        self.frames.close()
+
+
+class SharedDecoder:
+    """Один источник (процесс FFmpeg), кадры которого читают несколько подписчиков.
+
+    Кадры складываются в кольцевой буфер на capacity кадров; каждый подписчик читает
+    со своей позиции, а новые кадры из источника читает тот, кто ушёл дальше всех.
+    Буфер растёт по мере чтения, а когда новых подписчиков быть уже не может и остался
+    один, он освобождается, и кадры идут из источника напрямую.
+    """
+    def __init__(self, hub, key, source, capacity):
+        self.hub = hub
+        self.key = key
+        self.source = source
+        self.capacity = capacity
+        self.ring = []  # Кольцевой буфер; None — буфер освобождён, кадры идут напрямую
+        self.produced = 0  # Сколько кадров прочитано из источника
+        self.finished = False
+        self.subscribers = 0
+        self.reading = False  # Кто-то из подписчиков сейчас читает кадр из источника
+        self.lock = threading.Lock()  # Короткая блокировка состояния; source.read() вызывается без неё
+        self.condition = threading.Condition(self.lock)
+
+    def can_join(self):
+        """Новый подписчик начинает с первого кадра, поэтому он ещё должен быть в буфере."""
+        return self.produced < self.capacity and not self.finished
+
+    def frame(self, index):
+        """Кадр с номером index; b'' — конец трека, None — кадр уже вытеснен из буфера.
+
+        Блокирующее чтение из источника идёт вне блокировки, чтобы подписка на декодер
+        (в цикле событий) не ждала, пока FFmpeg отдаст кадр.
+        """
+        with self.condition:
+            while True:
+                if index == self.produced and self.subscribers == 1 and not self.can_join():
+                    # Единственный подписчик на переднем крае, и подключиться больше никто не сможет
+                    self.ring = None
+                if self.ring is not None:
+                    if index < self.produced - self.capacity:
+                        return None
+                    if index < self.produced:
+                        return self.ring[index % self.capacity]
+                if self.finished:
+                    return b''
+                if not self.reading:
+                    break
+                self.condition.wait()  # Кадр читает другой подписчик
+            self.reading = True
+
+        data = b''
+        try:
+            data = self.source.read()
+        finally:
+            with self.condition:
+                self.reading = False
+                if data:
+                    if self.ring is not None:
+                        if len(self.ring) < self.capacity:
+                            self.ring.append(data)
+                        else:
+                            self.ring[self.produced % self.capacity] = data
+                    self.produced += 1
+                else:
+                    self.finished = True
+                self.condition.notify_all()
+        return data
+
+    def unsubscribe(self):
+        with self.lock:
+            self.subscribers -= 1
+            if self.subscribers > 0:
+                return
+            self.finished = True
+            self.ring = []
+        self.hub.release(self)
+        self.source.cleanup()
+
+
+class SharedSource(discord.AudioSource):
+    """Подписка на SharedDecoder со своей позицией.
+
+    Если подписчик отстал больше чем на размер буфера (например, стоял на паузе),
+    он переходит на собственный источник, запущенный с нужной позиции.
+    """
+    def __init__(self, decoder, factory):
+        self.decoder = decoder
+        self.factory = factory  # factory(start_seconds) -> собственный источник
+        self.position = 0
+        self.fallback = None
+
+    def read(self):
+        if self.fallback is None:
+            data = self.decoder.frame(self.position)
+            if data is not None:
+                self.position += 1
+                return data
+            self.fallback = self.factory(self.position * FRAME_DURATION)
+            self.decoder.unsubscribe()
+        return self.fallback.read()
+
+    def is_opus(self):
+        return (self.fallback or self.decoder.source).is_opus()
+
+    def cleanup(self):
+        if self.fallback is not None:
+            self.fallback.cleanup()
+        elif self.decoder is not None:
+            self.decoder.unsubscribe()
+        self.decoder = None
+
+
+class DecoderHub:
+    """Общий для всех серверов реестр SharedDecoder: один трек — один процесс FFmpeg.
+
+    Серверы, начавшие один и тот же трек с разницей меньше размера буфера, подписываются
+    на один декодер; декодер останавливается, когда от него отписывается последний сервер.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.decoders = {}  # ключ трека -> последний SharedDecoder этого трека (к нему можно подключиться)
+        self.active = set()  # Все работающие декодеры
+        self.lock = threading.Lock()
+
+    def subscribe(self, key, factory):
+        """Подписка на трек; factory(start_seconds) запускает источник, если подходящего декодера нет."""
+        with self.lock:
+            decoder = self.decoders.get(key)
+            if decoder is not None:
+                with decoder.lock:
+                    if decoder.can_join():
+                        decoder.subscribers += 1
+                        return SharedSource(decoder, factory)
+            decoder = SharedDecoder(self, key, factory(0), self.capacity)
+            decoder.subscribers = 1
+            self.decoders[key] = decoder
+            self.active.add(decoder)
+            return SharedSource(decoder, factory)
+
+    def release(self, decoder):
+        with self.lock:
+            self.active.discard(decoder)
+            if self.decoders.get(decoder.key) is decoder:
+                del self.decoders[decoder.key]
+
+    def stats(self):
+        """Число работающих декодеров и подписчиков на них."""
+        with self.lock:
+            decoders = list(self.active)
+        return {'decoders': len(decoders), 'subscribers': sum(decoder.subscribers for decoder in decoders)}
+
+
+class PrebufferedSource(discord.AudioSource):
+    """Источник, первые кадры которого прочитаны заранее.
+
+    FFmpeg запускается и начинает отдавать звук ещё до того, как источник
+    понадобится, поэтому переключение на него не ждёт старта процесса.
+    """
+    def __init__(self, source, frames=25):
+        self.source = source
+        self.frames = frames
+        self.buffer = collections.deque()
+
+    def prebuffer(self):
+        """Читает первые кадры источника (блокирующий вызов, выполняется в потоке)."""
+        for _ in range(self.frames):
+            data = self.source.read()
+            if not data:
+                break
+            self.buffer.append(data)
+
+    def read(self):
+        if self.buffer:
+            return self.buffer.popleft()
+        return self.source.read()
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.buffer.clear()
+        self.source.cleanup()
+
+
+class GaplessSource(discord.AudioSource):
+    """Непрерывный выход плеера, который голосовой клиент играет вместо отдельных треков.
+
+    Когда текущий трек заканчивается (или пропускается), источник прямо в потоке
+    воспроизведения забирает у плеера подготовленный следующий трек — переключение
+    сводится к замене ссылки, без остановки и повторного запуска голосового клиента.
+    Если у плеера включён crossfade, конец трека плавно смешивается с началом следующего
+    (только для PCM-источников).
+    """
+    def __init__(self, player, track, source):
+        self.player = player
+        self.track = track
+        self.source = source
+        self.frames_played = 0
+        self.skip_requested = False
+        self.fade = None  # [трек, источник, номер кадра] во время crossfade
+
+    def advance(self):
+        """Переключается на подготовленный следующий трек. Возвращает False, если его нет."""
+        prepared = self.player.take_prepared()
+        self.source.cleanup()
+        if prepared is None:
+            return False
+        self.track, self.source = prepared
+        self.frames_played = 0
+        self.player.notify_track_started(self.track)
+        return True
+
+    def fade_frames_left(self):
+        """Сколько кадров осталось до конца текущего трека (None, если длительность неизвестна)."""
+        if not self.track.duration:
+            return None
+        return int(self.track.duration / FRAME_DURATION) - self.frames_played
+
+    def start_fade(self):
+        prepared = self.player.take_prepared()
+        if prepared is None:
+            return
+        if prepared[1].is_opus() or self.source.is_opus():
+            self.player.return_prepared(prepared)  # Opus-пакеты смешивать нельзя
+            return
+        self.fade = [prepared[0], prepared[1], 0]
+        self.player.notify_track_started(prepared[0])
+
+    def read_fade(self):
+        """Кадр crossfade: текущий трек затухает, следующий нарастает."""
+        track, source, frame = self.fade
+        total = self.player.crossfade_frames
+        outgoing = self.source.read()
+        incoming = source.read()
+        self.fade[2] += 1
+
+        if not outgoing or self.fade[2] >= total:
+            # Затухание закончилось: следующий трек становится текущим
+            self.source.cleanup()
+            self.track, self.source, self.frames_played = track, source, self.fade[2]
+            self.fade = None
+            return incoming or self.read()
+
+        outgoing = outgoing.ljust(PCM_FRAME_SIZE, b'\0')
+        incoming = incoming.ljust(PCM_FRAME_SIZE, b'\0')
+        position = frame / total
+        return audioop.add(audioop.mul(outgoing, 2, 1.0 - position), audioop.mul(incoming, 2, position), 2)
+
+    def read(self):
+        if self.skip_requested:
+            self.skip_requested = False
+            if self.fade:
+                self.finish_fade()
+            elif not self.advance():
+                return b''
+
+        if self.fade:
+            return self.read_fade()
+
+        if self.player.crossfade_frames:
+            left = self.fade_frames_left()
+            if left is not None and left <= self.player.crossfade_frames:
+                self.start_fade()
+                if self.fade:
+                    return self.read_fade()
+
+        data = self.source.read()
+        if not data:
+            if not self.advance():
+                return b''
+            data = self.source.read()
+        self.frames_played += 1
+        return data
+
+    def finish_fade(self):
+        """Досрочно завершает crossfade (при пропуске трека)."""
+        track, source, frame = self.fade
+        self.source.cleanup()
+        self.track, self.source, self.frames_played = track, source, frame
+        self.fade = None
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+        if self.fade:
+            self.fade[1].cleanup()
+            self.fade = None
+
+
+def load_pcm_clip(path, ffmpeg_executable, max_seconds=15):
+    """Декодирует звук в PCM (s16le, 48 кГц, стерео) в память: массив int16 для наложения."""
+    result = subprocess.run([ffmpeg_executable, '-nostdin', '-hide_banner', '-loglevel', 'error', '-i', path,
+                             '-t', str(max_seconds), '-vn', '-f', 's16le', '-ar', '48000', '-ac', '2', '-'],
+                            check=True, stdin=subprocess.DEVNULL, capture_output=True)
+    return np.frombuffer(result.stdout, dtype=np.int16)
+
+
+class MixerSource(discord.AudioSource):
+    """Выход голосового клиента, на который можно накладывать короткие звуки поверх трека.
+
+    Пока наложений нет, кадры основного источника проходят как есть (в том числе Opus-пакеты
+    без перекодирования). Во время наложения кадр переводится в PCM (Opus-пакет декодируется),
+    клипы прибавляются к нему векторно в NumPy с ограничением до диапазона int16,
+    а discord.py кодирует результат в Opus.
+    """
+    SAMPLES = PCM_FRAME_SIZE // 2  # Значений int16 в одном кадре
+
+    def __init__(self, source):
+        self.source = source
+        self.overlays = []  # [клип (int16), позиция в клипе]
+        self.lock = threading.Lock()
+        self.decoder = None
+        self.opus = False  # Последний отданный кадр — Opus-пакет (False до первого кадра, чтобы
+                           # голосовой клиент создал кодировщик для кадров с наложением)
+        self.ended = False
+
+    def add_overlay(self, clip):
+        """Начинает наложение клипа со следующего кадра (вызывается из цикла событий)."""
+        with self.lock:
+            self.overlays.append([clip, 0])
+
+    def read(self):
+        data = b'' if self.ended else self.source.read()
+        if not data:
+            self.ended = True
+        with self.lock:
+            overlays = list(self.overlays)
+        if not overlays:
+            self.decoder = None
+            self.opus = not self.ended and self.source.is_opus()
+            return data
+
+        if data and self.source.is_opus():
+            if self.decoder is None:
+                self.decoder = discord.opus.Decoder()
+            data = self.decoder.decode(bytes(data), fec=False)
+        else:
+            self.decoder = None
+
+        mix = np.zeros(self.SAMPLES, dtype=np.int32)
+        frame = np.frombuffer(data, dtype=np.int16)[:self.SAMPLES]
+        mix[:len(frame)] += frame
+        for overlay in overlays:
+            clip, position = overlay
+            chunk = clip[position:position + self.SAMPLES]
+            mix[:len(chunk)] += chunk
+            overlay[1] += self.SAMPLES
+        with self.lock:
+            self.overlays = [overlay for overlay in self.overlays if overlay[1] < len(overlay[0])]
+
+        self.opus = False
+        np.clip(mix, -32768, 32767, out=mix)
+        return mix.astype(np.int16).tobytes()
+
+    def is_opus(self):
+        return self.opus
+
+    def cleanup(self):
+        self.source.cleanup()
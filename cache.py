@@ -1,33 +1,628 @@
 import os
-from collections import OrderedDict
+import re
+import json
+import time
+import sqlite3
+import threading
+import concurrent.futures
+from collections import Counter, OrderedDict
+
+# Расширения, в которых yt-dlp сохраняет аудио (по outtmpl 'cache/%(id)s.%(ext)s')
+AUDIO_EXTENSIONS = ('webm', 'opus', 'm4a', 'mp3', 'ogg', 'mp4')
+# Дополнительные файлы трека (индекс Opus-пакетов): путь хранится в метаданных под этими ключами,
+# размер входит в размер записи, удаляются они вместе с треком
+SIDECAR_META_KEYS = ('packet_file',)
+SIDECAR_EXTENSIONS = ('opk',)
+# Метаданные, описывающие сам аудиофайл (формат, нормализация): для нового файла трека они недействительны
+FORMAT_META_KEYS = ('acodec', 'container', 'normalized', 'gain_db', 'gain_applied', 'loudness_lufs',
+                    *SIDECAR_META_KEYS)
+# Имя файла, который загрузил yt-dlp: ID видео YouTube. Остальные файлы в папке кэша
+# (например, звуки мем-команд) кэшу не принадлежат: их не индексируем и не удаляем
+VIDEO_ID_PATTERN = re.compile(r'[\w-]{11}')
+
+
+def is_download(video_id, path):
+    """Файл загружен yt-dlp под своим ID видео (а не положен в папку кэша под собственным именем)."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return bool(VIDEO_ID_PATTERN.fullmatch(video_id)) and stem == video_id
+
+
+def entry_files(entry):
+    """Все файлы записи индекса: аудиофайл и дополнительные файлы."""
+    return [entry['path'], *(entry['meta'][key] for key in SIDECAR_META_KEYS if entry['meta'].get(key))]
+
 
 class LRUCache:
-    """Реализуем LRU-кэш для хранения загруженных файлов."""
-    def __init__(self, cache_dir, max_size_gb):
-        self.cache = OrderedDict()  # трек ID -> путь к файлу
+    """Реализуем LRU-кэш для хранения загруженных файлов.
+
+    Индекс (ID -> путь, размер, время последнего доступа, число обращений, метаданные)
+    хранится в SQLite-файле внутри папки кэша и сверяется с содержимым папки при запуске.
+    """
+    def __init__(self, cache_dir, max_size_gb, index_name='index.sqlite3', low_water_ratio=0.9):
+        self.cache = OrderedDict()  # трек ID -> запись индекса (от самого старого к самому свежему)
         self.cache_dir = cache_dir
         self.max_size = max_size_gb * 1024 * 1024 * 1024  # Размер в байтах
+        # При превышении лимита чистим кэш сразу до этой отметки, чтобы не вытеснять по файлу на каждую вставку
+        self.low_water = int(self.max_size * low_water_ratio)
+        self.total_size = 0  # Текущий размер кэша в байтах, ведётся инкрементально
         if not os.path.exists(cache_dir):
             os.makedirs(cache_dir)
 
+        self.lock = threading.Lock()  # Индекс могут трогать фоновые потоки загрузки
+        self.db = sqlite3.connect(os.path.join(cache_dir, index_name), check_same_thread=False)
+        # WAL без fsync на каждый commit: обновление индекса не должно стоить дорогой записи на диск
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                video_id TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                meta TEXT NOT NULL DEFAULT '{}'
+            )
+        """)
+        self.db.commit()
+        self.load_index()
+
+    def load_index(self):
+        """Загружает индекс с диска и сверяет его с реальным содержимым папки кэша."""
+        rows = self.db.execute(
+            "SELECT video_id, path, size, last_access, hits, meta FROM tracks ORDER BY last_access").fetchall()
+        for video_id, path, size, last_access, hits, meta in rows:
+            self.cache[video_id] = {'path': path, 'size': size, 'last_access': last_access,
+                                    'hits': hits, 'meta': json.loads(meta)}
+            self.total_size += size
+
+        # Записи о посторонних файлах, проиндексированных раньше: забываем их, сами файлы не трогаем
+        for video_id in [video_id for video_id, entry in self.cache.items()
+                         if not VIDEO_ID_PATTERN.fullmatch(video_id) and 'title' not in entry['meta']]:
+            self.total_size -= self.cache.pop(video_id)['size']
+            self.db.execute("DELETE FROM tracks WHERE video_id = ?", (video_id,))
+
+        on_disk = {}
+        sidecars = []
+        for filename in os.listdir(self.cache_dir):
+            video_id, _, ext = filename.rpartition('.')
+            if ext in AUDIO_EXTENSIONS and VIDEO_ID_PATTERN.fullmatch(video_id):
+                on_disk[video_id] = os.path.join(self.cache_dir, filename)
+            elif video_id and ext in SIDECAR_EXTENSIONS:
+                sidecars.append(os.path.join(self.cache_dir, filename))
+
+        # Записи, файлы которых удалили извне
+        for video_id in [video_id for video_id, entry in self.cache.items() if not os.path.isfile(entry['path'])]:
+            entry = self.cache.pop(video_id)
+            self.total_size -= entry['size']
+            self.db.execute("DELETE FROM tracks WHERE video_id = ?", (video_id,))
+            for path in entry_files(entry)[1:]:
+                self.remove_file(path, reason='трек удалён из кэша')
+
+        # Пропавшие дополнительные файлы (трек будет обработан заново) и файлы без записи
+        referenced = set()
+        for video_id, entry in self.cache.items():
+            missing = [key for key in SIDECAR_META_KEYS
+                       if entry['meta'].get(key) and not os.path.isfile(entry['meta'][key])]
+            for key in missing:
+                del entry['meta'][key]
+            if missing:
+                self.total_size -= entry['size']
+                entry['size'] = sum(os.path.getsize(path) for path in entry_files(entry))
+                self.total_size += entry['size']
+                self.save_entry(video_id, entry)
+            referenced.update(os.path.abspath(path) for path in entry_files(entry)[1:])
+        for path in sidecars:
+            if os.path.abspath(path) not in referenced:
+                self.remove_file(path, reason='нет записи в индексе')
+
+        # Файлы, которых нет в индексе (например, загруженные до появления индекса)
+        new_files = [(video_id, path) for video_id, path in on_disk.items() if video_id not in self.cache]
+        new_files.sort(key=lambda item: os.path.getmtime(item[1]))
+        for video_id, path in new_files:
+            entry = {'path': path, 'size': os.path.getsize(path), 'last_access': os.path.getmtime(path),
+                     'hits': 0, 'meta': {}}
+            self.cache[video_id] = entry
+            self.total_size += entry['size']
+            self.save_entry(video_id, entry)
+
+        # Восстанавливаем порядок LRU после вставки найденных файлов
+        self.cache = OrderedDict(sorted(self.cache.items(), key=lambda item: item[1]['last_access']))
+        self.db.commit()
+        print(f"Кэш загружен: {len(self.cache)} треков, {self.total_size / 1024 ** 2:.1f} МБ", flush=True)
+        self.evict()
+
+    def save_entry(self, video_id, entry):
+        """Сохраняет запись индекса в SQLite (без commit)."""
+        self.db.execute(
+            "INSERT OR REPLACE INTO tracks (video_id, path, size, last_access, hits, meta) VALUES (?, ?, ?, ?, ?, ?)",
+            (video_id, entry['path'], entry['size'], entry['last_access'], entry['hits'],
+             json.dumps(entry['meta'], ensure_ascii=False)))
+
     def get_cache_size(self):
         """Возвращает текущий размер кэша в байтах."""
-        total_size = 0
-        for path in self.cache.values():
-            if os.path.exists(path):
-                total_size += os.path.getsize(path)
-        return total_size
+        return self.total_size
+
+    def get(self, video_id):
+        """Возвращает путь к файлу трека из индекса и отмечает обращение (для LRU), либо None.
+
+        Счётчик воспроизведений hits здесь не меняется: его ведёт record_play().
+        """
+        with self.lock:
+            entry = self.cache.get(video_id)
+            if entry is None:
+                return None
+            if not os.path.isfile(entry['path']):
+                self.total_size -= self.cache.pop(video_id)['size']
+                self.db.execute("DELETE FROM tracks WHERE video_id = ?", (video_id,))
+                self.db.commit()
+                for path in entry_files(entry)[1:]:
+                    self.remove_file(path, reason='трек удалён из кэша')
+                return None
+
+            entry['last_access'] = time.time()
+            self.cache.move_to_end(video_id)
+            self.db.execute("UPDATE tracks SET last_access = ? WHERE video_id = ?", (entry['last_access'], video_id))
+            self.db.commit()
+            return entry['path']
+
+    def record_play(self, video_id):
+        """Учитывает воспроизведение трека из кэша."""
+        with self.lock:
+            entry = self.cache.get(video_id)
+            if entry is None:
+                return
+            entry['hits'] += 1
+            self.db.execute("UPDATE tracks SET hits = ? WHERE video_id = ?", (entry['hits'], video_id))
+            self.db.commit()
+
+    def find_file(self, video_id):
+        """Ищет загруженный файл трека по ID видео. Возвращает путь или None."""
+        path = self.get(video_id)
+        if path:
+            return path
+
+        # Файл мог появиться в папке в обход индекса
+        for ext in AUDIO_EXTENSIONS:
+            path = os.path.join(self.cache_dir, f"{video_id}.{ext}")
+            if os.path.isfile(path):
+                self.add_to_cache(video_id, path)
+                return path
+        return None
+
+    def get_meta(self, video_id):
+        """Возвращает метаданные трека (название, автор и т.п.) или пустой словарь."""
+        entry = self.cache.get(video_id)
+        return dict(entry['meta']) if entry else {}
+
+    def update_meta(self, video_id, **meta):
+        """Дополняет метаданные трека, уже находящегося в кэше."""
+        with self.lock:
+            entry = self.cache.get(video_id)
+            if entry is None:
+                return
+            entry['meta'].update(meta)
+            self.db.execute("UPDATE tracks SET meta = ? WHERE video_id = ?",
+                            (json.dumps(entry['meta'], ensure_ascii=False), video_id))
+            self.db.commit()
+
+    def replace_file(self, video_id, file_path, **meta):
+        """Заменяет файл трека новым (например, после конвертации), удаляя старый с диска.
+
+        Дополнительные файлы старого файла устаревают и тоже удаляются.
+        """
+        with self.lock:
+            entry = self.cache.get(video_id)
+            if entry is None:
+                # Трек вытеснили, пока файл готовился: новый файл тоже не нужен
+                self.remove_file(file_path, reason='трек удалён из кэша')
+                return
+            old_files = entry_files(entry)
+            for key in SIDECAR_META_KEYS:
+                entry['meta'].pop(key, None)
+            new_size = os.path.getsize(file_path)
+            self.total_size += new_size - entry['size']
+            entry['path'] = file_path
+            entry['size'] = new_size
+            entry['meta'].update(meta)
+            self.save_entry(video_id, entry)
+            self.db.commit()
+            for path in old_files:
+                if os.path.abspath(path) != os.path.abspath(file_path):
+                    self.remove_file(path, reason='заменён новым файлом')
+            self.evict()
+
+    def attach_file(self, video_id, key, file_path):
+        """Привязывает к треку дополнительный файл (например, индекс Opus-пакетов).
+
+        Если трека уже нет в кэше, файл удаляется.
+        """
+        with self.lock:
+            entry = self.cache.get(video_id)
+            if entry is None:
+                self.remove_file(file_path, reason='трек удалён из кэша')
+                return
+            old_path = entry['meta'].get(key)
+            entry['meta'][key] = file_path
+            new_size = sum(os.path.getsize(path) for path in entry_files(entry))
+            self.total_size += new_size - entry['size']
+            entry['size'] = new_size
+            self.save_entry(video_id, entry)
+            self.db.commit()
+            if old_path and os.path.abspath(old_path) != os.path.abspath(file_path):
+                self.remove_file(old_path, reason='заменён новым файлом')
+            self.evict()
 
     def delete_lru(self):
         """Удаляет самый редко используемый файл (LRU)."""
         if self.cache:
-            lru_item, path = self.cache.popitem(last=False)
+            lru_item, entry = self.cache.popitem(last=False)
+            self.total_size -= entry['size']
+            self.db.execute("DELETE FROM tracks WHERE video_id = ?", (lru_item,))
+            self.db.commit()
+            for path in entry_files(entry):
+                self.remove_file(path)
+
+    def evict(self):
+        """При превышении лимита за один проход удаляет старые файлы до нижней отметки."""
+        if self.total_size <= self.max_size:
+            return
+
+        evicted = []
+        while self.cache and self.total_size > self.low_water:
+            video_id, entry = self.cache.popitem(last=False)
+            self.total_size -= entry['size']
+            evicted.append((video_id, entry))
+
+        self.db.executemany("DELETE FROM tracks WHERE video_id = ?", [(video_id,) for video_id, _ in evicted])
+        self.db.commit()
+        for _, entry in evicted:
+            for path in entry_files(entry):
+                self.remove_file(path)
+
+    def remove_file(self, path, reason='LRU кэш'):
+        """Удаляет файл кэша с диска."""
+        try:
             if os.path.exists(path):
                 os.remove(path)
-                print(f"Удален файл {path} (LRU кэш)")
+                print(f"Удален файл {path} ({reason})")
+        except OSError as e:
+            print(f"Не удалось удалить файл {path}: {str(e)}", flush=True)
 
-    def add_to_cache(self, video_id, file_path):
+    def add_to_cache(self, video_id, file_path, **meta):
         """Добавляем файл в кэш и удаляем старые файлы при превышении лимита."""
-        self.cache[video_id] = file_path
-        while self.get_cache_size() > self.max_size:
-            self.delete_lru()
+        with self.lock:
+            old_entry = self.cache.get(video_id)
+            same_file = old_entry is not None and os.path.abspath(old_entry['path']) == os.path.abspath(file_path)
+            # Другой файл (повторная загрузка) обрабатывается заново: его формат и громкость ещё неизвестны
+            stale_keys = SIDECAR_META_KEYS if same_file else FORMAT_META_KEYS
+            old_meta = {key: value for key, value in old_entry['meta'].items()
+                        if key not in stale_keys} if old_entry else {}
+            entry = {'path': file_path, 'size': os.path.getsize(file_path), 'last_access': time.time(),
+                     'hits': old_entry['hits'] if old_entry else 0,
+                     'meta': {**old_meta, **meta}}
+            if old_entry:
+                self.total_size -= old_entry['size']
+            self.cache[video_id] = entry
+            self.cache.move_to_end(video_id)
+            self.total_size += entry['size']
+            self.save_entry(video_id, entry)
+            self.db.commit()
+            if old_entry:
+                for path in entry_files(old_entry)[1 if same_file else 0:]:
+                    self.remove_file(path, reason='заменён новым файлом')
+            self.evict()
+
+
+class FrameCache:
+    """Кэш горячих треков в памяти в виде готовых Opus-пакетов (oggopus.OpusFrames).
+
+    Ведёт счётчик воспроизведений всех треков; трек загружается в память, когда сыграл
+    min_plays раз. Объём ограничен max_bytes; при нехватке места вытесняются треки
+    с наименьшим числом воспроизведений (LFU), но только если они играли реже нового.
+    """
+    def __init__(self, max_bytes, min_plays=3):
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.entries = {}  # ключ (ID видео или путь к файлу) -> OpusFrames
+        self.plays = Counter()  # ключ -> число воспроизведений
+        self.loading = set()  # Ключи, которые сейчас загружаются
+        self.total_size = 0
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='frames')
+
+    def get(self, key):
+        """Возвращает OpusFrames трека или None."""
+        with self.lock:
+            return self.entries.get(key)
+
+    def record_play(self, key, plays=1):
+        """Учитывает воспроизведение трека."""
+        with self.lock:
+            self.plays[key] += plays
+
+    def wants(self, key):
+        """Трек играет достаточно часто, но ещё не загружен в память."""
+        with self.lock:
+            return self.plays[key] >= self.min_plays and key not in self.entries and key not in self.loading
+
+    def load(self, key, loader):
+        """Загружает трек в фоне: loader() выполняется в потоке и возвращает OpusFrames."""
+        with self.lock:
+            if key in self.entries or key in self.loading:
+                return
+            self.loading.add(key)
+        try:
+            self.executor.submit(self.run_loader, key, loader)
+        except RuntimeError:
+            # Пул уже остановлен (например, при перезагрузке плеера)
+            with self.lock:
+                self.loading.discard(key)
+
+    def run_loader(self, key, loader):
+        try:
+            frames = loader()
+            if self.put(key, frames):
+                print(f"Трек {key} загружен в память: {len(frames)} кадров, {frames.size / 1024:.0f} КБ. "
+                      f"Занято {self.total_size / 1024 ** 2:.1f} МБ", flush=True)
+        except Exception as e:
+            print(f"Не удалось загрузить трек {key} в память: {str(e)}", flush=True)
+        finally:
+            with self.lock:
+                self.loading.discard(key)
+
+    def put(self, key, frames):
+        """Добавляет трек, вытесняя реже играемые. Возвращает False, если места для него нет."""
+        with self.lock:
+            if frames.size > self.max_bytes:
+                return False
+            victims = []
+            free = self.max_bytes - self.total_size
+            for victim in sorted(self.entries, key=lambda k: self.plays[k]):
+                if free >= frames.size:
+                    break
+                if self.plays[victim] >= self.plays[key]:
+                    return False  # Остальные треки в памяти играют не реже нового
+                victims.append(victim)
+                free += self.entries[victim].size
+            if free < frames.size:
+                return False
+
+            for victim in victims:
+                self.total_size -= self.entries.pop(victim).size
+            self.entries[key] = frames
+            self.total_size += frames.size
+            return True
+
+    def shutdown(self):
+        """Останавливает загрузку, отменяя ещё не начатые задачи."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SearchCache:
+    """Кэш результатов поиска: нормализованный запрос -> ID видео.
+
+    Хранится в SQLite-файле в папке кэша и целиком загружается в память, так что повторный
+    поиск разрешается словарём без обращения к сети. Записи старше ttl секунд не используются
+    (выдача поиска со временем меняется). Счётчики обращений копятся в памяти и сбрасываются
+    на диск вместе со следующей записью или при flush().
+    """
+    def __init__(self, cache_dir, ttl=7 * 24 * 3600, index_name='searches.sqlite3'):
+        self.ttl = ttl
+        self.entries = {}  # запрос -> {'video_id', 'resolved_at', 'hits'}
+        self.dirty = set()  # Запросы с несохранёнными счётчиками обращений
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.db = sqlite3.connect(os.path.join(cache_dir, index_name), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS searches (
+                query TEXT PRIMARY KEY,
+                video_id TEXT NOT NULL,
+                resolved_at REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.db.execute("DELETE FROM searches WHERE resolved_at < ?", (time.time() - ttl,))
+        self.db.commit()
+        for query, video_id, resolved_at, hits in self.db.execute(
+                "SELECT query, video_id, resolved_at, hits FROM searches"):
+            self.entries[query] = {'video_id': video_id, 'resolved_at': resolved_at, 'hits': hits}
+        print(f"Кэш поиска загружен: {len(self.entries)} запросов", flush=True)
+
+    def get(self, query):
+        """Возвращает ID видео для нормализованного запроса или None."""
+        with self.lock:
+            entry = self.entries.get(query)
+            if entry is None or time.time() - entry['resolved_at'] > self.ttl:
+                self.misses += 1
+                return None
+            entry['hits'] += 1
+            self.hits += 1
+            self.dirty.add(query)
+            return entry['video_id']
+
+    def put(self, query, video_id):
+        """Запоминает результат поиска."""
+        with self.lock:
+            old = self.entries.get(query)
+            hits = old['hits'] if old and old['video_id'] == video_id else 0
+            self.entries[query] = {'video_id': video_id, 'resolved_at': time.time(), 'hits': hits}
+            self.dirty.add(query)
+            self.save_dirty()
+
+    def discard(self, query):
+        """Забывает результат поиска (например, если найденное видео стало недоступно)."""
+        with self.lock:
+            if self.entries.pop(query, None) is not None:
+                self.dirty.discard(query)
+                self.db.execute("DELETE FROM searches WHERE query = ?", (query,))
+                self.db.commit()
+
+    def save_dirty(self):
+        """Сохраняет изменённые записи (вызывается под self.lock)."""
+        self.db.executemany(
+            "INSERT OR REPLACE INTO searches (query, video_id, resolved_at, hits) VALUES (?, ?, ?, ?)",
+            [(query, entry['video_id'], entry['resolved_at'], entry['hits'])
+             for query, entry in ((query, self.entries.get(query)) for query in self.dirty) if entry])
+        self.db.commit()
+        self.dirty.clear()
+
+    def flush(self):
+        """Сбрасывает накопленные счётчики обращений на диск."""
+        with self.lock:
+            if self.dirty:
+                self.save_dirty()
+
+    def stats(self):
+        """Число запросов в кэше, попаданий и промахов."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+class PlaylistStore:
+    """Сохранённые плейлисты: (ID сервера, имя) -> список запросов в порядке добавления.
+
+    У каждого сервера свои плейлисты. Хранятся в SQLite-файле в папке кэша и целиком
+    держатся в памяти. В плейлист записываются сами запросы, а не ссылки на потоки:
+    при воспроизведении они разрешаются заново (повторные — через кэш поиска и кэш файлов).
+    Плейлисты, сохранённые до разделения по серверам, достаются первому серверу,
+    который к ним обратится.
+    """
+    LEGACY_GUILD = -1  # Владелец плейлистов из общей таблицы старого формата
+
+    def __init__(self, cache_dir, index_name='playlists.sqlite3'):
+        self.playlists = {}  # (ID сервера, имя) -> [запрос, ...]
+        self.lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.db = sqlite3.connect(os.path.join(cache_dir, index_name), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(playlists)")]
+        if columns and 'guild_id' not in columns:
+            # Старый формат без сервера: переносим записи, пометив их как ничьи
+            self.db.execute("ALTER TABLE playlists RENAME TO playlists_legacy")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS playlists (
+                guild_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                query TEXT,
+                PRIMARY KEY (guild_id, name, position)
+            )
+        """)
+        if columns and 'guild_id' not in columns:
+            self.db.execute("INSERT INTO playlists (guild_id, name, position, query) "
+                            "SELECT ?, name, position, query FROM playlists_legacy", (self.LEGACY_GUILD,))
+            self.db.execute("DROP TABLE playlists_legacy")
+        self.db.commit()
+        for guild_id, name, query in self.db.execute(
+                "SELECT guild_id, name, query FROM playlists ORDER BY guild_id, name, position"):
+            queries = self.playlists.setdefault((guild_id, name), [])
+            if query is not None:
+                queries.append(query)
+        print(f"Плейлисты загружены: {len(self.playlists)}", flush=True)
+
+    def lookup(self, guild_id, name):
+        """Запросы плейлиста сервера или None (вызывается под self.lock).
+
+        Ничей плейлист старого формата с таким именем переходит этому серверу.
+        """
+        queries = self.playlists.get((guild_id, name))
+        if queries is None and (self.LEGACY_GUILD, name) in self.playlists:
+            queries = self.playlists.pop((self.LEGACY_GUILD, name))
+            self.playlists[(guild_id, name)] = queries
+            self.db.execute("UPDATE playlists SET guild_id = ? WHERE guild_id = ? AND name = ?",
+                            (guild_id, self.LEGACY_GUILD, name))
+            self.db.commit()
+        return queries
+
+    def create(self, guild_id, name):
+        """Создаёт пустой плейлист сервера. Возвращает False, если такой уже есть."""
+        with self.lock:
+            if self.lookup(guild_id, name) is not None:
+                return False
+            self.playlists[(guild_id, name)] = []
+            # Пустой плейлист хранится строкой-заглушкой с позицией -1
+            self.db.execute("INSERT INTO playlists (guild_id, name, position, query) VALUES (?, ?, -1, NULL)",
+                            (guild_id, name))
+            self.db.commit()
+            return True
+
+    def add(self, guild_id, name, query):
+        """Добавляет запрос в конец плейлиста сервера. Возвращает False, если плейлиста нет."""
+        with self.lock:
+            queries = self.lookup(guild_id, name)
+            if queries is None:
+                return False
+            self.db.execute("INSERT INTO playlists (guild_id, name, position, query) VALUES (?, ?, ?, ?)",
+                            (guild_id, name, len(queries), query))
+            self.db.commit()
+            queries.append(query)
+            return True
+
+    def get(self, guild_id, name):
+        """Запросы плейлиста сервера или None, если плейлиста нет."""
+        with self.lock:
+            queries = self.lookup(guild_id, name)
+            return list(queries) if queries is not None else None
+
+
+class NegativeCache:
+    """Отрицательный кэш: запросы и видео, которые недавно не удалось получить.
+
+    Запись живёт ttls[класс ошибки] секунд; при каждой повторной неудаче срок удваивается
+    (не больше max_ttl). Пока запись жива, повторный запрос сразу получает сохранённую ошибку
+    и не занимает поток загрузчика.
+    """
+    def __init__(self, ttls, max_ttl=24 * 3600):
+        self.ttls = ttls  # класс ошибки -> базовое время жизни записи, сек
+        self.max_ttl = max_ttl
+        self.entries = {}  # ключ (запрос или ID видео) -> запись
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def get(self, *keys):
+        """Возвращает действующую запись для первого найденного ключа или None."""
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                if entry['expires'] <= now:
+                    continue  # Запись устарела, но счётчик неудач нужен для следующего срока
+                self.hits += 1
+                return entry
+            return None
+
+    def add(self, keys, error_class, message):
+        """Запоминает неудачу под всеми ключами. Возвращает запись."""
+        now = time.time()
+        with self.lock:
+            failures = max((self.entries[key]['failures'] for key in keys if key in self.entries), default=0) + 1
+            ttl = min(self.ttls.get(error_class, self.ttls['transient']) * 2 ** (failures - 1), self.max_ttl)
+            entry = {'error': error_class, 'message': message, 'failures': failures, 'expires': now + ttl}
+            for key in keys:
+                self.entries[key] = entry
+            # Заодно выбрасываем записи, которые давно истекли
+            for key in [key for key, old in self.entries.items() if old['expires'] + self.max_ttl <= now]:
+                del self.entries[key]
+            return entry
+
+    def discard(self, *keys):
+        """Забывает неудачи (например, когда трек всё-таки удалось получить)."""
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        """Число действующих записей и отклонённых по ним запросов."""
+        now = time.time()
+        with self.lock:
+            return {'entries': sum(1 for entry in self.entries.values() if entry['expires'] > now), 'hits': self.hits}
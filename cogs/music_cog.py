@@ -1,21 +1,48 @@
 import importlib
+import itertools
 import asyncio
+import time
 import os
 
 from discord.ext import commands
 import music_player  # Импортируем модуль music_player
-from collections import deque
+
+# Звуки мем-команд
+GOYDA_PATH = r"cache\\Okhlabystin_-_gojjda_76690131.mp3" if os.name == 'nt' else "/cache/Okhlabystin_-_gojjda_76690131.mp3"
+RICKROLL_PATH = r"cache\\Rick_Astley_-_Never_Gonna_Give_You_Up_47958276.mp3" if os.name == 'nt' else "/cache/Rick_Astley_-_Never_Gonna_Give_You_Up_47958276.mp3"
+
+# Приоритеты команд: управляющие команды обгоняют ожидающие в очереди запросы на воспроизведение
+CONTROL_PRIORITY = 0
+PLAY_PRIORITY = 1
 
 
 class MusicCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.music_player = music_player.MusicPlayer(bot, bot.voice_clients[0] if bot.voice_clients else None)
-
-        # Очередь для команд
-        self.command_queue = deque()
-        self.is_processing = False  # Флаг для отслеживания выполнения команд
-        self.bot.loop.create_task(self.process_commands())  # Запуск обработчика очереди
+        self.players = music_player.PlayerRegistry(bot)  # Отдельный плеер на каждый сервер
+        self.preload_sounds()
+
+        # Очереди команд и обработчики: отдельные для каждого сервера
+        self.command_queues = {}  # guild ID -> asyncio.PriorityQueue
+        self.workers = {}  # guild ID -> asyncio.Task
+        self.worker_idle_timeout = 300  # Через сколько секунд простоя обработчик сервера завершается
+        self.command_counter = itertools.count()  # Сохраняет порядок команд с одинаковым приоритетом
+
+        # Одинаковые команды, пришедшие в пределах окна, схлопываются в одну
+        self.coalesce_window = 1.5
+        self.recent_commands = {}  # (guild ID, ключ команды) -> время последнего приёма
+
+    def preload_sounds(self):
+        """Держим звуки мем-команд в памяти: Opus-пакетами для очереди и в PCM для наложения."""
+        for path in (GOYDA_PATH, RICKROLL_PATH):
+            if os.path.isfile(path):
+                self.players.preload(path, path)
+                self.bot.loop.create_task(self.players.preload_clip(path))
+
+    def cog_unload(self):
+        self.players.close()
+        for worker in self.workers.values():
+            worker.cancel()
 
     @commands.Cog.listener()
     async def on_command(self, ctx):
@@ -23,47 +50,157 @@ class MusicCog(commands.Cog):
         print(f"Команда {ctx.command} была введена пользователем {ctx.author} в канале {ctx.channel}", flush=True)
 
     # Добавляем команды в очередь
-    async def add_to_command_queue(self, ctx, command):
-        """Добавляем команду в очередь и выводим её в лог."""
+    async def add_to_command_queue(self, ctx, command, priority=PLAY_PRIORITY, coalesce_key=None):
+        """Добавляем команду в очередь сервера и выводим её в лог.
+
+        Если передан coalesce_key и такая же команда уже принималась на этом сервере
+        в пределах coalesce_window секунд, новая команда отбрасывается. Схлопываются только
+        повторы подряд: любая другая команда сбрасывает окно (pause, resume, pause — три команды).
+        """
+        guild_id = ctx.guild.id if ctx.guild else None
+        if coalesce_key is not None:
+            now = time.monotonic()
+            last = self.recent_commands.get((guild_id, coalesce_key))
+            if last is not None and now - last < self.coalesce_window:
+                print(f"Команда {coalesce_key} от {ctx.author} объединена с предыдущей.", flush=True)
+                return
+        for key in [key for key in self.recent_commands if key[0] == guild_id and key[1] != coalesce_key]:
+            del self.recent_commands[key]
+        if coalesce_key is not None:
+            self.recent_commands[(guild_id, coalesce_key)] = now
+
         print(f"Добавляем команду {command.__name__} в очередь от {ctx.author}.", flush=True)
-        self.command_queue.append((ctx, command))
-
-    # Асинхронный обработчик очереди
-    async def process_commands(self):
-        """Асинхронный процесс обработки команд из очереди."""
-        while True:
-            if self.command_queue and not self.is_processing:
-                self.is_processing = True  # Устанавливаем флаг обработки
-                ctx, command = self.command_queue.popleft()  # Извлекаем команду из очереди
+        queue = self.command_queues.get(guild_id)
+        if queue is None:
+            queue = self.command_queues[guild_id] = asyncio.PriorityQueue()
+        queue.put_nowait((priority, next(self.command_counter), ctx, command))
+
+        if guild_id not in self.workers:
+            self.workers[guild_id] = self.bot.loop.create_task(self.process_commands(guild_id, queue))
+
+    def drop_pending(self, guild_id, priority=PLAY_PRIORITY):
+        """Убирает из очереди сервера ещё не начатые команды с данным приоритетом. Возвращает их число."""
+        queue = self.command_queues.get(guild_id)
+        if queue is None:
+            return 0
+        kept = []
+        dropped = 0
+        while not queue.empty():
+            item = queue.get_nowait()
+            queue.task_done()
+            if item[0] == priority:
+                dropped += 1
+            else:
+                kept.append(item)
+        for item in kept:
+            queue.put_nowait(item)
+        return dropped
+
+    # Асинхронный обработчик очереди сервера
+    async def process_commands(self, guild_id, queue):
+        """Выполняет команды одного сервера по очереди; команды разных серверов не ждут друг друга."""
+        try:
+            while True:
+                try:
+                    _, _, ctx, command = await asyncio.wait_for(queue.get(), timeout=self.worker_idle_timeout)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        break  # Сервер давно молчит, обработчик создадим заново при следующей команде
+                    continue
                 try:
                     await command(ctx)  # Выполняем команду и ожидаем её завершения
                 except Exception as e:
                     print(f"Ошибка при выполнении команды: {str(e)}", flush=True)
-                self.is_processing = False  # Сбрасываем флаг после завершения
-            await asyncio.sleep(0.1)  # Короткая пауза для предотвращения перегрузки цикла
+                finally:
+                    queue.task_done()
+        finally:
+            if self.workers.get(guild_id) is asyncio.current_task():
+                del self.workers[guild_id]
+                del self.command_queues[guild_id]
+                for key in [key for key in self.recent_commands if key[0] == guild_id]:
+                    del self.recent_commands[key]
 
     # Обертываем команды для их добавления в очередь
     @commands.command(name='play', help='Воспроизведение музыки')
     async def play(self, ctx, *, query):
-        await self.add_to_command_queue(ctx, lambda ctx: self.music_player.add_to_queue(ctx, query))
+        await self.add_to_command_queue(ctx, lambda ctx: self.players.get(ctx.guild).add_to_queue(ctx, query))
+
+    @commands.command(name='playmany', help='Добавить несколько треков: запросы через ; или с новой строки')
+    async def playmany(self, ctx, *, queries):
+        queries = [query.strip() for line in queries.splitlines() for query in line.split(';') if query.strip()]
+        await self.add_to_command_queue(ctx, lambda ctx: self.players.get(ctx.guild).add_many(ctx, queries))
+
+    @commands.command(name='create_playlist', help='Создать плейлист')
+    async def create_playlist(self, ctx, name):
+        await self.add_to_command_queue(ctx, lambda ctx: self.players.get(ctx.guild).create_playlist(ctx, name),
+                                        priority=CONTROL_PRIORITY)
+
+    @commands.command(name='add_to_playlist', help='Добавить трек в плейлист')
+    async def add_to_playlist(self, ctx, name, *, query):
+        await self.add_to_command_queue(
+            ctx, lambda ctx: self.players.get(ctx.guild).add_to_playlist(ctx, name, query), priority=CONTROL_PRIORITY)
+
+    @commands.command(name='play_playlist', help='Воспроизвести плейлист')
+    async def play_playlist(self, ctx, name):
+        await self.add_to_command_queue(ctx, lambda ctx: self.players.get(ctx.guild).play_playlist(ctx, name))
 
     @commands.command(name='GOYDA', help='ГООООЙДАААА!!!!')
     async def goyda(self, ctx):
-        query = r"cache\\Okhlabystin_-_gojjda_76690131.mp3" if os.name == 'nt' else "/cache/Okhlabystin_-_gojjda_76690131.mp3"
-        await self.add_to_command_queue(ctx, lambda ctx: self.music_player.add_to_queue(ctx, query))
+        await self.add_to_command_queue(ctx, lambda ctx: self.players.get(ctx.guild).overlay(ctx, GOYDA_PATH),
+                                        priority=CONTROL_PRIORITY)
 
     @commands.command(name='rickroll', help='Ну нажми че ты')
     async def rick(self, ctx):
-        query = r"cache\\Rick_Astley_-_Never_Gonna_Give_You_Up_47958276.mp3" if os.name == 'nt' else "/cache/Rick_Astley_-_Never_Gonna_Give_You_Up_47958276.mp3"
-        await self.add_to_command_queue(ctx, lambda ctx: self.music_player.add_to_queue(ctx, query))
+        await self.add_to_command_queue(ctx, lambda ctx: self.players.get(ctx.guild).overlay(ctx, RICKROLL_PATH),
+                                        priority=CONTROL_PRIORITY)
 
     @commands.command(name='skip', help='Пропустить текущий трек')
     async def skip(self, ctx):
-        await self.add_to_command_queue(ctx, self.music_player.skip)
+        await self.add_to_command_queue(ctx, lambda ctx: self.players.get(ctx.guild).skip(ctx),
+                                        priority=CONTROL_PRIORITY, coalesce_key='skip')
 
     @commands.command(name='stop', help='Остановить воспроизведение')
     async def stop(self, ctx):
-        await self.add_to_command_queue(ctx, self.music_player.stop)
+        # stop обгоняет очередь, поэтому отправленные раньше него запросы на воспроизведение отменяем:
+        # иначе они выполнились бы после остановки и снова запустили музыку
+        dropped = self.drop_pending(ctx.guild.id if ctx.guild else None)
+        if dropped:
+            print(f"Команда stop отменила {dropped} ожидающих команд воспроизведения.", flush=True)
+        await self.add_to_command_queue(ctx, lambda ctx: self.players.get(ctx.guild).stop(ctx),
+                                        priority=CONTROL_PRIORITY, coalesce_key='stop')
+
+    @commands.command(name='remove', help='Удалить трек из очереди по номеру')
+    async def remove(self, ctx, position: int):
+        await self.add_to_command_queue(ctx, lambda ctx: self.players.get(ctx.guild).remove(ctx, position),
+                                        priority=CONTROL_PRIORITY)
+
+    @commands.command(name='pause', help='Поставить на паузу')
+    async def pause(self, ctx):
+        await self.add_to_command_queue(ctx, lambda ctx: self.players.get(ctx.guild).pause(ctx),
+                                        priority=CONTROL_PRIORITY, coalesce_key='pause')
+
+    @commands.command(name='resume', help='Возобновить воспроизведение')
+    async def resume(self, ctx):
+        await self.add_to_command_queue(ctx, lambda ctx: self.players.get(ctx.guild).resume(ctx),
+                                        priority=CONTROL_PRIORITY, coalesce_key='resume')
+
+    @commands.command(name='stats', help='Статистика загрузчика и плееров')
+    async def stats(self, ctx):
+        stats = self.players.extractor.stats()
+        decoders = self.players.decoders.stats()
+        searches = self.players.searches.stats()
+        failures = self.players.failures.stats()
+        await ctx.send(
+            f"Активных плееров: {len(self.players.players)}\n"
+            f"Процессов FFmpeg: {decoders['decoders']}, слушателей на них: {decoders['subscribers']}\n"
+            f"Загрузчик: потоков {stats['workers']}, в работе {stats['active']}, в очереди {stats['queued']}\n"
+            f"Выполнено: {stats['completed']}, ошибок: {stats['failed']}, "
+            f"объединено одинаковых: {stats['deduplicated']}, отменено: {stats['cancelled']}\n"
+            f"Ожидание в очереди: среднее {stats['avg_wait']:.2f} с, максимум {stats['max_wait']:.2f} с\n"
+            f"Среднее время запроса: {stats['avg_run']:.2f} с\n"
+            f"Кэш поиска: {searches['entries']} запросов, попаданий {searches['hits']}, "
+            f"промахов {searches['misses']} ({searches['hit_rate']:.0%})\n"
+            f"Отрицательный кэш: {failures['entries']} записей, отклонено запросов {failures['hits']}")
 
     @commands.command(name='reload_player', help='Перезагрузить логику музыкального плеера')
     @commands.has_permissions(administrator=True)
@@ -73,9 +210,10 @@ class MusicCog(commands.Cog):
 
     async def reload_player_internal(self, ctx):
         try:
+            self.players.close()
             importlib.reload(music_player)  # Перезагружаем модуль music_player
-            self.music_player = music_player.MusicPlayer(self.bot,
-                                                         self.bot.voice_clients[0] if self.bot.voice_clients else None)
+            self.players = music_player.PlayerRegistry(self.bot)
+            self.preload_sounds()
             await ctx.send("Модуль music_player успешно перезагружен.")
         except Exception as e:
             await ctx.send(f"Произошла ошибка при перезагрузке music_player: {str(e)}")
@@ -0,0 +1,334 @@
+import os
+import time
+import uuid
+import shutil
+import queue
+import asyncio
+import itertools
+import threading
+import concurrent.futures
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadCancelled
+
+# Приоритеты задач пула: меньше — раньше
+PRIORITY_HIGH = 0  # Запросы, которых пользователь ждёт прямо сейчас
+PRIORITY_LOW = 1  # Предзагрузка и фоновое кэширование
+
+# Классы ошибок yt-dlp по тексту сообщения (для отрицательного кэша)
+ERROR_CLASSES = [
+    ('unavailable', ('video unavailable', 'has been removed', 'private video', 'copyright',
+                     'account associated with this video has been terminated')),
+    ('geo_blocked', ('not available in your country', 'geo restriction', 'geo-restricted')),
+    ('age_restricted', ('confirm your age', 'age-restricted', 'inappropriate for some users')),
+    ('not_found', ('unsupported url', 'is not a valid url', 'ничего не найдено')),
+]
+
+
+def classify_error(error):
+    """Класс ошибки получения трека: постоянная (unavailable, geo_blocked, ...) или transient."""
+    message = str(error).lower()
+    for error_class, patterns in ERROR_CLASSES:
+        if any(pattern in message for pattern in patterns):
+            return error_class
+    return 'transient'
+
+
+class ExtractorPool:
+    """Общий пул потоков для yt-dlp.
+
+    Число одновременных загрузок ограничено размером пула, а каждый поток
+    работает со своим экземпляром YoutubeDL (он не потокобезопасен).
+    Одинаковые запросы, пришедшие одновременно, выполняются один раз (single-flight),
+    а загрузка идёт во временную папку и переносится в кэш атомарным переименованием.
+    Задачи берутся из очереди по приоритету: фоновые не задерживают пользовательские.
+    Если все ожидающие задачу отменились, задача тоже отменяется: ещё не начатая
+    выбрасывается из очереди, а идущая загрузка прерывается из хука прогресса yt-dlp.
+    """
+    def __init__(self, options, max_workers=4):
+        self.options = options
+        self.max_workers = max_workers
+        self.local = threading.local()  # YoutubeDL отдельного потока
+        self.inflight = {}  # (ключ, download) -> (задача asyncio, описание задачи пула)
+        self.jobs = queue.PriorityQueue()  # (приоритет, порядковый номер, задача)
+        self.job_counter = itertools.count()
+        self.threads = [threading.Thread(target=self.worker, name=f'ytdl-{i}', daemon=True)
+                        for i in range(max_workers)]
+
+        # Загрузки пишутся сюда и переносятся в папку кэша только целиком
+        self.output_dir, self.output_template = os.path.split(options['outtmpl'])
+        self.temp_dir = os.path.join(self.output_dir, '.tmp')
+        self.cleanup_temp_dir()
+
+        # Метрики
+        self.lock = threading.Lock()
+        self.queued = 0  # Задачи, ждущие свободного потока
+        self.active = 0  # Задачи, выполняющиеся сейчас
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0  # Суммарное время ожидания в очереди, сек
+        self.max_wait = 0.0
+        self.total_run = 0.0  # Суммарное время выполнения, сек
+        self.deduplicated = 0  # Запросы, присоединившиеся к уже выполняющимся
+        self.cancelled = 0  # Задачи, отменённые до завершения
+
+        for thread in self.threads:
+            thread.start()
+
+    def cleanup_temp_dir(self, max_age=3600):
+        """Удаляет временные папки, брошенные прерванными загрузками."""
+        if not os.path.isdir(self.temp_dir):
+            return
+        now = time.time()
+        for name in os.listdir(self.temp_dir):
+            path = os.path.join(self.temp_dir, name)
+            if now - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def get_ytdl(self):
+        """Возвращает экземпляр YoutubeDL текущего потока, создавая его при первом обращении."""
+        ytdl = getattr(self.local, 'ytdl', None)
+        if ytdl is None:
+            ytdl = self.local.ytdl = YoutubeDL(self.options)
+            ytdl.add_progress_hook(self.dispatch_progress)
+        return ytdl
+
+    def dispatch_progress(self, status):
+        """Хук прогресса yt-dlp: передаёт событие подписчикам текущей задачи потока.
+
+        Здесь же проверяется отмена задачи: исключение DownloadCancelled прерывает загрузку.
+        """
+        job = getattr(self.local, 'job', None)
+        if job is None:
+            return
+        if job['cancelled']:
+            raise DownloadCancelled(f"Загрузка отменена: {job['query']}")
+        job['last_progress'] = status
+        for hook in list(job['hooks']):
+            try:
+                hook(status)
+            except Exception as e:
+                print(f"Ошибка в обработчике прогресса загрузки: {str(e)}", flush=True)
+
+    def worker(self):
+        """Цикл потока пула: берёт задачи в порядке приоритета."""
+        while True:
+            _, _, job = self.jobs.get()
+            if job is None:
+                break  # Пул остановлен
+
+            with self.lock:
+                # Задача могла попасть в очередь дважды (при повышении приоритета) или быть отменена
+                if job['started']:
+                    continue
+                job['started'] = True
+                self.queued -= 1
+            if not job['future'].set_running_or_notify_cancel():
+                with self.lock:
+                    self.cancelled += 1
+                continue
+
+            self.local.job = job
+            try:
+                job['future'].set_result(self.run_job(job))
+            except BaseException as e:
+                job['future'].set_exception(e)
+            finally:
+                self.local.job = None
+
+    def submit(self, query, download, priority, key, progress_hook=None, entries_hook=None):
+        """Ставит задачу в очередь пула."""
+        job = {'future': concurrent.futures.Future(), 'submitted': time.monotonic(), 'key': key, 'query': query,
+               'download': download, 'priority': priority, 'started': False, 'cancelled': False,
+               'waiters': 0, 'hooks': [progress_hook] if progress_hook else [], 'last_progress': None,
+               'entries_hook': entries_hook}
+        with self.lock:
+            self.queued += 1
+        self.jobs.put((priority, next(self.job_counter), job))
+        return job
+
+    def raise_priority(self, job, priority):
+        """Повышает приоритет ещё не начатой задачи, ставя её копию в очередь раньше остальных."""
+        with self.lock:
+            if job['started'] or priority >= job['priority']:
+                return
+            job['priority'] = priority
+        self.jobs.put((priority, next(self.job_counter), job))
+
+    def cancel(self, job):
+        """Отменяет задачу, которую больше никто не ждёт."""
+        job['cancelled'] = True  # Идущую загрузку прервёт dispatch_progress
+        job['future'].cancel()  # Ещё не начатую задачу поток пула пропустит
+        self.forget(job)  # Новые такие же запросы не должны присоединяться к отменённой задаче
+
+    def finished(self, job, task):
+        """Колбэк завершения задачи пула в цикле событий."""
+        self.forget(job)
+        if not task.cancelled():
+            task.exception()  # Ошибку отменённой задачи может никто не ждать: помечаем её полученной
+
+    def forget(self, job):
+        """Убирает задачу из списка выполняющихся, если там ещё она, а не новая с тем же ключом."""
+        inflight = self.inflight.get(job['key'])
+        if inflight is not None and inflight[1] is job:
+            del self.inflight[job['key']]
+
+    def run_job(self, job):
+        """Выполняется в потоке пула."""
+        query, download = job['query'], job['download']
+        started = time.monotonic()
+        wait = started - job['submitted']
+        with self.lock:
+            self.active += 1
+            self.max_wait = max(self.max_wait, wait)
+
+        ok = False
+        try:
+            if job['entries_hook']:
+                result = self.stream_playlist(job, job['entries_hook'])
+            elif download:
+                result = self.download(query)
+            else:
+                result = self.get_ytdl().extract_info(query, download=False)
+            ok = True
+            return result
+        finally:
+            with self.lock:
+                self.active -= 1
+                if ok or not job['cancelled']:
+                    # Средние считаются по завершённым задачам, отменённые в них не входят
+                    self.total_wait += wait
+                    self.total_run += time.monotonic() - started
+                if ok:
+                    self.completed += 1
+                elif job['cancelled']:
+                    self.cancelled += 1
+                else:
+                    self.failed += 1
+
+    def download(self, query):
+        """Загружает трек во временную папку и атомарно переносит готовый файл в кэш."""
+        ytdl = self.get_ytdl()
+        job_dir = os.path.join(self.temp_dir, uuid.uuid4().hex)
+        ytdl.params['outtmpl'] = {'default': os.path.join(job_dir, self.output_template)}
+        try:
+            data = ytdl.extract_info(query, download=True)
+            for video in data.get('entries') or [data]:
+                if not video:
+                    continue
+                downloads = video.get('requested_downloads') or [{}]
+                temp_path = downloads[0].get('filepath') or ytdl.prepare_filename(video)
+                if not os.path.isfile(temp_path):
+                    continue
+                final_path = os.path.join(self.output_dir, os.path.basename(temp_path))
+                os.replace(temp_path, final_path)
+                for item in downloads:
+                    item['filepath'] = final_path
+            return data
+        finally:
+            ytdl.params['outtmpl'] = {'default': self.options['outtmpl']}
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    def stream_playlist(self, job, entries_hook, batch_size=50):
+        """Плоское извлечение плейлиста: записи передаются в entries_hook пачками по мере загрузки страниц."""
+        ytdl = self.get_ytdl()
+        ytdl.params.update(extract_flat='in_playlist', noplaylist=False)
+        try:
+            # process=False оставляет entries генератором: страницы плейлиста запрашиваются по мере обхода
+            info = ytdl.extract_info(job['query'], download=False, process=False)
+            batch = []
+            count = 0
+            for entry in info.get('entries') or []:
+                if job['cancelled']:
+                    raise DownloadCancelled(f"Загрузка плейлиста отменена: {job['query']}")
+                if not entry:
+                    continue
+                batch.append(entry)
+                count += 1
+                if len(batch) >= batch_size:
+                    entries_hook(batch)
+                    batch = []
+            if batch:
+                entries_hook(batch)
+            return {'id': info.get('id'), 'title': info.get('title'), 'count': count}
+        finally:
+            for option in ('extract_flat', 'noplaylist'):
+                if option in self.options:
+                    ytdl.params[option] = self.options[option]
+                else:
+                    ytdl.params.pop(option, None)
+
+    async def extract_playlist(self, url, on_entries, priority=PRIORITY_HIGH):
+        """Потоковое плоское извлечение плейлиста.
+
+        on_entries(список записей) вызывается в цикле событий для каждой пачки записей,
+        пока плейлист ещё загружается. Возвращает {'id', 'title', 'count'}.
+        """
+        loop = asyncio.get_running_loop()
+        job = self.submit(url, False, priority, None,
+                          entries_hook=lambda entries: loop.call_soon_threadsafe(on_entries, entries))
+        task = asyncio.wrap_future(job['future'])
+        task.add_done_callback(lambda _: self.finished(job, task))
+        return await self.wait(job, task)
+
+    async def extract_info(self, query, download=False, key=None, priority=PRIORITY_HIGH, progress_hook=None):
+        """Асинхронная обёртка над YoutubeDL.extract_info, выполняемая в пуле.
+
+        key — ключ для объединения одинаковых запросов (нормализованный запрос или ID видео);
+        по умолчанию используется сам запрос. progress_hook вызывается из потока пула
+        с событиями прогресса yt-dlp. Отмена корутины отменяет и саму задачу пула,
+        если её больше никто не ждёт.
+        """
+        flight_key = (key or query, download)
+        inflight = self.inflight.get(flight_key)
+        if inflight is not None:
+            task, job = inflight
+            with self.lock:
+                self.deduplicated += 1
+            # Фоновую задачу, которую теперь ждёт пользователь, выполняем вне очереди
+            self.raise_priority(job, priority)
+            if progress_hook:
+                job['hooks'].append(progress_hook)
+                if job['last_progress'] is not None:
+                    progress_hook(job['last_progress'])  # Догоняем события, пришедшие до подписки
+        else:
+            job = self.submit(query, download, priority, flight_key, progress_hook)
+            task = asyncio.wrap_future(job['future'])
+            self.inflight[flight_key] = (task, job)
+            task.add_done_callback(lambda _: self.finished(job, task))
+
+        return await self.wait(job, task)
+
+    async def wait(self, job, task):
+        """Ожидание задачи пула; если её перестали ждать все, задача отменяется."""
+        job['waiters'] += 1
+        try:
+            # shield: отмена одного из ожидающих не должна прерывать запрос остальных
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if job['waiters'] == 1 and not task.done():
+                self.cancel(job)
+            raise
+        finally:
+            job['waiters'] -= 1
+
+    def stats(self):
+        """Снимок метрик пула."""
+        with self.lock:
+            finished = self.completed + self.failed
+            return {
+                'workers': self.max_workers,
+                'queued': self.queued,
+                'active': self.active,
+                'completed': self.completed,
+                'failed': self.failed,
+                'deduplicated': self.deduplicated,
+                'cancelled': self.cancelled,
+                'avg_wait': self.total_wait / finished if finished else 0.0,
+                'max_wait': self.max_wait,
+                'avg_run': self.total_run / finished if finished else 0.0,
+            }
+
+    def shutdown(self):
+        """Останавливает пул, не дожидаясь завершения текущих задач."""
+        for _ in self.threads:
+            self.jobs.put((float('inf'), next(self.job_counter), None))
@@ -0,0 +1,169 @@
+import os
+import re
+import threading
+import subprocess
+import concurrent.futures
+
+from cache import is_download
+from oggopus import PACKET_FILE_EXTENSION, parse_ogg_opus, write_packet_file
+
+# Единый формат библиотеки: Ogg/Opus 48 кГц стерео
+LIBRARY_EXTENSION = 'opus'
+
+# Нормализация громкости по EBU R128
+MAX_BOOST_DB = 12.0  # Тихие треки не усиливаем сильнее, чтобы не поднимать шум
+MIN_GAIN_DB = 1.0  # Меньшую разницу на слух не заметно, Opus-дорожку ради неё не перекодируем
+SILENCE_LUFS = -70.0  # Такие значения ebur128 выдаёт для тишины
+
+def probe_codec(ffmpeg_executable, path):
+    """Определяет кодек первой аудиодорожки через ffprobe, лежащий рядом с FFmpeg."""
+    directory, name = os.path.split(ffmpeg_executable)
+    ffprobe = os.path.join(directory, name.replace('ffmpeg', 'ffprobe'))
+    result = subprocess.run([ffprobe, '-v', 'error', '-select_streams', 'a:0', '-show_entries',
+                             'stream=codec_name', '-of', 'default=noprint_wrappers=1:nokey=1', path],
+                            check=True, capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+class IngestPool:
+    """Фоновая обработка загруженных треков.
+
+    Каждый трек в кэше один раз приводится к формату Ogg/Opus: Opus-дорожка
+    перепаковывается без перекодирования, остальные кодеки перекодируются
+    с битрейтом канала. Заодно один раз измеряется громкость (EBU R128), и
+    поправка громкости сразу вписывается в файл библиотеки, так что при
+    воспроизведении нормализация ничего не стоит. Наконец, Opus-пакеты файла выкладываются
+    в файл пакетов с индексом смещений, который играется без FFmpeg. Пул маленький и работает
+    с пониженным приоритетом, чтобы не отнимать процессор у воспроизведения.
+    """
+    def __init__(self, cache, ffmpeg_executable, max_workers=1, bitrate_kbps=128, target_lufs=-14.0):
+        self.cache = cache
+        self.ffmpeg_executable = ffmpeg_executable
+        self.bitrate_kbps = bitrate_kbps
+        self.target_lufs = target_lufs
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        self.lock = threading.Lock()
+        self.pending = set()  # ID треков, уже поставленных в обработку
+
+    def submit(self, video_id):
+        """Ставит трек в очередь обработки (повторная постановка игнорируется)."""
+        with self.lock:
+            if video_id in self.pending:
+                return
+            self.pending.add(video_id)
+        try:
+            self.executor.submit(self.process, video_id)
+        except RuntimeError:
+            # Пул уже остановлен (например, при перезагрузке плеера)
+            with self.lock:
+                self.pending.discard(video_id)
+
+    def backfill(self):
+        """Ставит в обработку все треки кэша, которые ещё не приведены к единому формату."""
+        for video_id, entry in list(self.cache.cache.items()):
+            if is_download(video_id, entry['path']) and not self.is_processed(entry['meta']):
+                self.submit(video_id)
+
+    @staticmethod
+    def is_processed(meta):
+        """Трек приведён к формату библиотеки, измерен и для него построен файл пакетов.
+
+        packet_file=False означает, что файл пакетов построить нельзя (кадры не по 20 мс).
+        """
+        return bool(meta.get('normalized')) and 'loudness_lufs' in meta and 'packet_file' in meta
+
+    def run_ffmpeg(self, args, loglevel='error'):
+        """Запускает FFmpeg с пониженным приоритетом процесса. Возвращает вывод stderr."""
+        preexec_fn = (lambda: os.nice(10)) if os.name == 'posix' else None
+        result = subprocess.run([self.ffmpeg_executable, '-nostdin', '-y', '-hide_banner', '-nostats',
+                                 '-loglevel', loglevel, *args],
+                                check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, text=True, errors='replace', preexec_fn=preexec_fn)
+        return result.stderr
+
+    def measure_loudness(self, path):
+        """Измеряет интегральную громкость файла (LUFS) фильтром ebur128."""
+        output = self.run_ffmpeg(['-i', path, '-vn', '-af', 'ebur128=framelog=quiet', '-f', 'null', '-'],
+                                 loglevel='info')
+        values = re.findall(r'I:\s+(-?\d+(?:\.\d+)?) LUFS', output)
+        if not values:
+            raise ValueError("ebur128 не вернул интегральную громкость")
+        return float(values[-1])
+
+    def gain_for(self, loudness_lufs):
+        """Поправка громкости в дБ, приводящая трек к целевому уровню."""
+        if loudness_lufs <= SILENCE_LUFS:
+            return 0.0
+        return round(min(self.target_lufs - loudness_lufs, MAX_BOOST_DB), 2)
+
+    def probe_codec(self, path):
+        return probe_codec(self.ffmpeg_executable, path)
+
+    def build_packet_file(self, video_id, path):
+        """Выкладывает Opus-пакеты файла библиотеки в файл пакетов и привязывает его к треку."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        try:
+            frames = parse_ogg_opus(data)
+        except ValueError as e:
+            print(f"Файл пакетов для трека {video_id} не построен: {str(e)}", flush=True)
+            self.cache.update_meta(video_id, packet_file=False)
+            return
+        packet_path = os.path.join(self.cache.cache_dir, f"{video_id}.{PACKET_FILE_EXTENSION}")
+        write_packet_file(packet_path, frames)
+        self.cache.attach_file(video_id, 'packet_file', packet_path)
+
+    def process(self, video_id):
+        """Выполняется в потоке пула: конвертирует файл трека и обновляет индекс кэша."""
+        temp_path = None
+        try:
+            entry = self.cache.cache.get(video_id)
+            if entry is None or self.is_processed(entry['meta']):
+                return
+            source_path = entry['path']
+            if not os.path.isfile(source_path) or not is_download(video_id, source_path):
+                return  # Файлы, на которые бот ссылается по имени (звуки мем-команд), не конвертируем
+
+            loudness = entry['meta'].get('loudness_lufs')
+            if loudness is None:
+                loudness = self.measure_loudness(source_path)
+            gain = self.gain_for(loudness)
+            needs_gain = abs(gain) >= MIN_GAIN_DB and not entry['meta'].get('gain_applied')
+
+            if entry['meta'].get('normalized') and not needs_gain:
+                # Файл уже в нужном формате, достаточно запомнить результат измерения
+                self.cache.update_meta(video_id, loudness_lufs=loudness, gain_db=gain, gain_applied=True)
+                self.build_packet_file(video_id, source_path)
+                return
+
+            target_path = os.path.join(self.cache.cache_dir, f"{video_id}.{LIBRARY_EXTENSION}")
+            temp_path = target_path + '.part'
+            acodec = entry['meta'].get('acodec') or self.probe_codec(source_path)
+            if acodec == 'opus' and not needs_gain:
+                codec_args = ['-c:a', 'copy']
+            else:
+                codec_args = ['-c:a', 'libopus', '-b:a', f'{self.bitrate_kbps}k', '-ar', '48000', '-ac', '2']
+                if needs_gain:
+                    # Постоянное усиление с лимитером, чтобы поднятый трек не клиппировал
+                    codec_args = ['-af', f'volume={gain}dB,alimiter=limit=0.98', *codec_args]
+            self.run_ffmpeg(['-i', source_path, '-vn', '-map_metadata', '-1', *codec_args, '-f', 'ogg', temp_path])
+            os.replace(temp_path, target_path)
+
+            self.cache.replace_file(video_id, target_path, acodec='opus', container='ogg', normalized=True,
+                                    loudness_lufs=loudness, gain_db=gain, gain_applied=True)
+            print(f"Трек {video_id} приведён к формату Ogg/Opus (громкость {loudness} LUFS, поправка {gain} дБ).",
+                  flush=True)
+            self.build_packet_file(video_id, target_path)
+        except subprocess.CalledProcessError as e:
+            print(f"Ошибка конвертации трека {video_id}: {(e.stderr or '').strip()}", flush=True)
+        except Exception as e:
+            print(f"Ошибка обработки трека {video_id}: {str(e)}", flush=True)
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+            with self.lock:
+                self.pending.discard(video_id)
+
+    def shutdown(self):
+        """Останавливает пул, отменяя ещё не начатые задачи."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
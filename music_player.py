@@ -1,10 +1,17 @@
 import os
+import re
+import time
+import threading
 
 import discord
 import asyncio
-import concurrent.futures
+from audio import (DecoderHub, GaplessSource, GrowingFile, MixerSource, OpusFramesSource, PacketFileSource,
+                   PipedSource, PrebufferedSource, FRAME_DURATION, load_pcm_clip)
 from yt_dlp import YoutubeDL
-from cache import LRUCache
+from cache import FrameCache, LRUCache, NegativeCache, PlaylistStore, SearchCache
+from extractor import ExtractorPool, PRIORITY_LOW, classify_error
+from ingest import IngestPool, probe_codec
+from oggopus import PacketFile, load_opus_frames
 
 ytdl_format_options = {
     'format': 'bestaudio/best',
@@ -18,18 +25,214 @@ ffmpeg_options = {
     'options': '-vn'
 }
 
+# Опции для воспроизведения напрямую по URL: FFmpeg переподключается при обрывах соединения
+ffmpeg_stream_options = {
+    'before_options': '-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+    'options': '-vn'
+}
+
+# Режим стриминга: играем сразу по прямой ссылке, не дожидаясь загрузки файла
+STREAM_MODE = True
+# Докачивать ли файл в кэш в фоне при стриминге (для быстрых повторных воспроизведений)
+CACHE_IN_BACKGROUND = True
+# Без стриминга: начинать воспроизведение из файла, который ещё загружается, не дожидаясь конца загрузки.
+# Требует POSIX: на Windows открытый файл нельзя переименовать при переносе в кэш
+PROGRESSIVE_DOWNLOAD = os.name == 'posix'
+# Сколько следующих треков очереди заранее загружать в кэш
+PREFETCH_DEPTH = 2
+# Плавный переход между треками, секунд (0 — выключен). Требует декодирования в PCM,
+# поэтому при включении Opus-треки воспроизводятся с перекодированием
+CROSSFADE_SECONDS = 0
+# Сколько запросов к yt-dlp может выполняться одновременно (общий пул на все серверы)
+EXTRACTOR_WORKERS = 8
+# Сколько треков одной пакетной команды (,playmany, ,play_playlist) разрешается одновременно.
+# Меньше EXTRACTOR_WORKERS, чтобы длинный список не занимал весь пул и не задерживал другие серверы
+BATCH_RESOLVE_LIMIT = 6
+# Фоновая конвертация кэша в Ogg/Opus: число потоков и битрейт (как у голосового канала)
+INGEST_WORKERS = 1
+INGEST_BITRATE_KBPS = 128
+# Целевая громкость треков в кэше (EBU R128)
+LOUDNESS_TARGET_LUFS = -14.0
+# Горячие треки держим в памяти готовыми Opus-пакетами и играем без FFmpeg:
+# лимит памяти, сколько воспроизведений нужно для загрузки и сколько самых популярных треков кэша загрузить при старте
+FRAME_CACHE_MB = 256
+FRAME_CACHE_MIN_PLAYS = 3
+FRAME_CACHE_WARM_TRACKS = 20
+# Серверы, запустившие один трек с разницей меньше этого окна, читают кадры одного процесса FFmpeg.
+# Буфер окна (до ~2 МБ на PCM-декодер) держится, только пока к декодеру ещё можно подключиться
+FANOUT_WINDOW_SECONDS = 10
+# Звуки, накладываемые поверх трека (,GOYDA, ,rickroll), держим в памяти в PCM не длиннее этого
+OVERLAY_MAX_SECONDS = 15
+# Сколько дней помнить, какое видео нашлось по текстовому запросу
+SEARCH_CACHE_TTL_DAYS = 7
+# Отрицательный кэш: сколько секунд не повторять запрос, который завершился ошибкой данного класса
+# (при повторных неудачах срок удваивается)
+NEGATIVE_CACHE_TTLS = {
+    'unavailable': 6 * 3600,
+    'geo_blocked': 6 * 3600,
+    'age_restricted': 6 * 3600,
+    'not_found': 3600,
+    'transient': 60,
+}
+
+# Шаблоны ссылок YouTube, из которых ID видео можно достать без обращения к сети
+youtube_id_patterns = [
+    re.compile(r'(?:www\.|m\.|music\.)?youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/|v/)([\w-]{11})'),
+    re.compile(r'youtu\.be/([\w-]{11})'),
+]
+# Ссылка на плейлист целиком (ссылки на видео с параметром list= играют одно видео, см. noplaylist)
+playlist_pattern = re.compile(r'youtube\.com/playlist\?(?:[^#]*&)?list=([\w-]+)')
+
 ytdl = YoutubeDL(ytdl_format_options)
 ffmpeg_executable = "C:\\ProgramData\\chocolatey\\bin\\ffmpeg.exe" if os.name == 'nt' else "/usr/bin/ffmpeg"
 
+def normalize_query(query):
+    """Приводит поисковый запрос к единому виду (регистр, лишние пробелы)."""
+    return ' '.join(query.lower().split())
+
+
+def lookup_video_id(query, searches):
+    """Определяет ID видео по ссылке или по ранее выполненному поиску, не обращаясь к сети."""
+    if query.startswith("http"):
+        for pattern in youtube_id_patterns:
+            match = pattern.search(query)
+            if match:
+                return match.group(1)
+        return None
+    return searches.get(normalize_query(query))
+
+
+def failure_keys(query, video_id=None):
+    """Ключи отрицательного кэша для запроса: ID видео (если известен) и сам запрос."""
+    keys = [video_id] if video_id else []
+    keys.append(query if query.startswith("http") else normalize_query(query))
+    return keys
+
+
+def playlist_track(entry):
+    """Лёгкий элемент очереди из записи плоского извлечения плейлиста (без ссылки на поток)."""
+    url = entry.get('url') or f"https://www.youtube.com/watch?v={entry['id']}"
+    track = Track(url, title=entry.get('title'), author=entry.get('uploader') or entry.get('channel') or 'Unknown author')
+    track.video_id = entry.get('id')
+    track.duration = entry.get('duration')
+    track.lazy = True
+    track.quiet = True
+    return track
+
+
+def first_entry(data):
+    """Первое видео из результата yt-dlp (для поиска — первый результат)."""
+    if 'entries' not in data:
+        return data
+    entries = list(data['entries'] or [])
+    if not entries:
+        raise LookupError("По запросу ничего не найдено")
+    return entries[0]
+
+
+def remember_track(query, video, searches):
+    """Запоминает ID видео для поискового запроса, чтобы в следующий раз найти трек без поиска."""
+    video_id = video.get('id')
+    if video_id and not query.startswith("http"):
+        searches.put(normalize_query(query), video_id)
+
+
+class Track:
+    """Элемент очереди воспроизведения.
+
+    Пока трек ищется или загружается, он стоит в очереди в состоянии PENDING;
+    location заполняется, когда становится известен файл в кэше или прямая ссылка на поток.
+    """
+    PENDING = 'pending'
+    READY = 'ready'
+    FAILED = 'failed'
+
+    def __init__(self, query, title=None, author='Unknown author'):
+        self.query = query
+        self.title = title or query
+        self.author = author
+        self.video_id = None
+        self.webpage_url = None  # Ссылка на страницу видео (для загрузки в кэш)
+        self.location = None  # Путь к файлу, прямая ссылка на поток или загружаемый файл (GrowingFile)
+        self.stream = False
+        self.progressive = False  # location — GrowingFile, файл ещё загружается
+        self.http_headers = {}
+        self.codec = None  # Аудиокодек источника; для 'opus' FFmpeg не перекодирует звук
+        self.duration = None  # Длительность в секундах, если известна
+        self.state = Track.PENDING
+        self.error = None
+        self.resolve_task = None  # Фоновая задача разрешения запроса
+        self.download_task = None  # Загрузка, которая продолжается во время воспроизведения (PROGRESSIVE_DOWNLOAD)
+        self.lazy = False  # Элемент плейлиста: разрешается, только когда до него дойдёт предзагрузка
+        self.quiet = False  # Не сообщать о загрузке трека (элементы плейлистов и пакетных команд)
+
+    def set_ready(self, location, stream=False, http_headers=None, codec=None, progressive=False):
+        self.location = location
+        self.stream = stream
+        self.progressive = progressive
+        self.http_headers = http_headers or {}
+        self.codec = codec
+        self.state = Track.READY
+
+    def fail(self, error=None):
+        self.error = error
+        self.state = Track.FAILED
+
+    def frame_key(self):
+        """Ключ трека в кэше кадров: ID видео или путь к локальному файлу."""
+        if self.video_id:
+            return self.video_id
+        return None if self.stream or self.progressive else self.location
+
+    def cancel(self):
+        """Отменяет фоновое разрешение и загрузку трека, если они ещё идут.
+
+        Загрузка в пуле yt-dlp при этом прерывается, а недокачанный файл удаляется.
+        """
+        for task in (self.resolve_task, self.download_task):
+            if task and not task.done():
+                task.cancel()
+        if self.state == Track.PENDING:
+            self.fail()
+
+
 class MusicPlayer():
-    def __init__(self, bot, voice_client=None):
+    def __init__(self, bot, voice_client=None, cache=None, extractor=None, ingest=None, frames=None, decoders=None,
+                 clips=None, searches=None, failures=None, playlists=None):
         self.bot = bot
         self.queue = []
         self.current = None
         self.voice_client = voice_client
-        self.cache = LRUCache('cache', max_size_gb=5)
+        self.cache = cache or LRUCache('cache', max_size_gb=5)
+        self.extractor = extractor or ExtractorPool(ytdl_format_options, max_workers=EXTRACTOR_WORKERS)
+        self.ingest = ingest or IngestPool(self.cache, ffmpeg_executable, max_workers=INGEST_WORKERS,
+                                           bitrate_kbps=INGEST_BITRATE_KBPS, target_lufs=LOUDNESS_TARGET_LUFS)
+        self.frames = frames or FrameCache(FRAME_CACHE_MB * 1024 * 1024, min_plays=FRAME_CACHE_MIN_PLAYS)
+        self.decoders = decoders or DecoderHub(int(FANOUT_WINDOW_SECONDS / FRAME_DURATION))
+        self.clips = clips if clips is not None else {}  # путь -> PCM-клип для наложения
+        self.searches = searches or SearchCache('cache', ttl=SEARCH_CACHE_TTL_DAYS * 24 * 3600)
+        self.failures = failures or NegativeCache(NEGATIVE_CACHE_TTLS)
+        self.playlists = playlists or PlaylistStore('cache')
         self.lock = asyncio.Lock()
         self.inactivity_task = None  # Задача для отслеживания простоя
+        self.prefetch_tasks = {}  # Track -> задача предзагрузки в кэш
+        self.playlist_tasks = set()  # Задачи загрузки плейлистов
+        self.ctx = None  # Контекст последней команды (для сообщений при смене трека)
+        self.output = None  # GaplessSource, который сейчас играет голосовой клиент
+        self.mixer = None  # MixerSource поверх output: через него накладываются звуки
+        self.prepared = None  # (трек, источник) следующего трека с уже запущенным FFmpeg
+        self.prepared_lock = threading.Lock()  # prepared забирается из потока воспроизведения
+        self.crossfade_frames = int(CROSSFADE_SECONDS / FRAME_DURATION)
+        self.last_activity = time.monotonic()  # Время последнего действия (для освобождения простаивающих плееров)
+
+    def is_busy(self):
+        """Голосовой клиент играет трек или стоит на паузе."""
+        return self.voice_client is not None and (self.voice_client.is_playing() or self.voice_client.is_paused())
+
+    def is_idle(self):
+        """Плеер ничего не играет, не держит голосовое подключение и его очередь пуста."""
+        connected = self.voice_client is not None and self.voice_client.is_connected()
+        return not connected and not self.queue
 
     async def join_channel(self, ctx):
         """Присоединение к голосовому каналу пользователя."""
@@ -54,29 +257,137 @@ class MusicPlayer():
         return True
 
     async def play_next(self, ctx):
-        """Воспроизведение следующего трека."""
+        """Воспроизведение следующего трека.
+
+        Используется, когда ничего не играет; дальше треки сменяют друг друга
+        внутри GaplessSource без участия этого метода.
+        """
+        self.last_activity = time.monotonic()
+        self.ctx = ctx
         async with self.lock:
             if not self.voice_client or not self.voice_client.is_connected():
                 return
 
+            if self.is_busy():
+                return  # Следующий трек уже запущен (например, из resolve_track)
+
+            # Пропускаем упавшие треки и отложенные элементы плейлиста, которые есть в отрицательном кэше
+            dropped = False
+            while self.queue:
+                if self.queue[0].state == Track.FAILED:
+                    self.queue.pop(0)
+                elif self.start_resolve(self.queue[0]):
+                    dropped = True
+                else:
+                    break
+            if dropped:
+                self.schedule_prefetch()  # Окно предзагрузки сдвинулось: разрешаем следующие треки
+
             if len(self.queue) == 0:
                 await ctx.send("Очередь пуста. Покидаю голосовой канал.")
                 await self.disconnect_from_channel()
                 return
 
-            self.current = self.queue.pop(0)
-            await ctx.send(f"Сейчас играет: {self.current.title}")
-            self.voice_client.play(self.current,
-                                   after=lambda e: asyncio.run_coroutine_threadsafe(self.track_finished(ctx), self.bot.loop))
+            if self.queue[0].state == Track.PENDING:
+                # Трек ещё загружается: resolve_track запустит его сам, как только он будет готов
+                print(f"Ожидаем загрузки трека {self.queue[0].query}", flush=True)
+                return
 
-            await ctx.send(f"Осталось треков в очереди: {len(self.queue)}")
+            track = self.queue[0]
+            prepared = self.take_prepared()
+            if prepared is not None and prepared[0] is track:
+                source = prepared[1]
+            else:
+                if prepared is not None:
+                    prepared[1].cleanup()
+                self.refresh_location(track)
+                source = self.create_source(track)
+
+            self.queue.pop(0)
+            self.current = track
+            self.output = GaplessSource(self, track, source)
+            self.mixer = MixerSource(self.output)
+            self.voice_client.play(self.mixer,
+                                   after=lambda e: asyncio.run_coroutine_threadsafe(self.track_finished(ctx), self.bot.loop))
+            await self.announce(ctx, track)
 
             if self.inactivity_task:
                 self.inactivity_task.cancel()
                 self.inactivity_task = None
 
+        await self.prepare_next()
+
+    async def announce(self, ctx, track):
+        """Сообщения о начале трека и запуск фоновой подготовки следующих."""
+        self.schedule_prefetch()
+        self.count_play(track)
+        await ctx.send(f"Сейчас играет: {track.title}")
+        await ctx.send(f"Осталось треков в очереди: {len(self.queue)}")
+
+    def take_prepared(self):
+        """Забирает подготовленный следующий трек (вызывается и из потока воспроизведения)."""
+        with self.prepared_lock:
+            prepared, self.prepared = self.prepared, None
+            return prepared
+
+    def return_prepared(self, prepared):
+        """Возвращает неиспользованный подготовленный трек."""
+        with self.prepared_lock:
+            if self.prepared is None:
+                self.prepared = prepared
+                return
+        prepared[1].cleanup()
+
+    def discard_prepared(self):
+        """Останавливает заранее запущенный FFmpeg следующего трека."""
+        prepared = self.take_prepared()
+        if prepared is not None:
+            prepared[1].cleanup()
+
+    async def prepare_next(self):
+        """Заранее запускает FFmpeg следующего трека и читает его первые кадры."""
+        if self.output is None or not self.queue or self.queue[0].state != Track.READY:
+            return
+
+        track = self.queue[0]
+        with self.prepared_lock:
+            if self.prepared is not None and self.prepared[0] is track:
+                return
+        self.discard_prepared()
+
+        self.refresh_location(track)
+        source = PrebufferedSource(self.create_source(track))
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, source.prebuffer)
+        except Exception as e:
+            print(f"Не удалось подготовить трек {track.title}: {str(e)}", flush=True)
+            source.cleanup()
+            return
+
+        with self.prepared_lock:
+            if self.output is not None and self.queue and self.queue[0] is track and self.prepared is None:
+                self.prepared = (track, source)
+                return
+        source.cleanup()  # Пока готовили, очередь изменилась
+
+    def notify_track_started(self, track):
+        """Вызывается из потока воспроизведения, когда GaplessSource переключился на следующий трек."""
+        asyncio.run_coroutine_threadsafe(self.track_started(track), self.bot.loop)
+
+    async def track_started(self, track):
+        """Обновляет очередь после бесшовного переключения трека."""
+        self.last_activity = time.monotonic()
+        if self.queue and self.queue[0] is track:
+            self.queue.pop(0)
+        self.current = track
+        if self.ctx:
+            await self.announce(self.ctx, track)
+        await self.prepare_next()
+
     async def track_finished(self, ctx):
-        """Обработчик завершения трека, который вызывает play_next."""
+        """Обработчик завершения воспроизведения (следующий трек не был подготовлен), вызывает play_next."""
+        self.output = None
+        self.mixer = None
         if len(self.queue) > 0:
             await self.play_next(ctx)
         else:
@@ -84,74 +395,614 @@ class MusicPlayer():
             self.inactivity_task = asyncio.create_task(self.disconnect_after_inactivity(ctx))
 
     async def add_to_queue(self, ctx, query):
-        """Добавление трека в очередь."""
+        """Добавление трека в очередь.
+
+        Трек попадает в очередь сразу; если его нужно искать или загружать,
+        он остаётся в состоянии PENDING, пока resolve_track работает в фоне.
+        """
+        self.last_activity = time.monotonic()
         if not await self.join_channel(ctx):
             return
 
-            # Если query — это путь к локальному файлу, добавляем его напрямую
+        # Если query — это путь к локальному файлу, добавляем его напрямую
         if os.path.isfile(query):
-            source = discord.FFmpegPCMAudio(query, executable=ffmpeg_executable, **ffmpeg_options)
-            source.title = os.path.basename(query)
-            self.queue.append(source)
-            await ctx.send(f"Локальный трек добавлен в очередь: {source.title}")
+            track = Track(query, title=os.path.basename(query))
+            track.set_ready(query)
+            await self.enqueue(ctx, track)
+            return
 
-            if not self.voice_client.is_playing():
-                await self.play_next(ctx)
+        if playlist_pattern.search(query):
+            task = self.bot.loop.create_task(self.load_playlist(ctx, query))
+            self.playlist_tasks.add(task)
+            task.add_done_callback(self.playlist_tasks.discard)
+            return
 
+        # Быстрый путь: трек уже лежит в кэше, сеть не нужна
+        video_id = lookup_video_id(query, self.searches)
+        failure = self.failures.get(*failure_keys(query, video_id))
+        if failure:
+            # Такой же запрос недавно завершился ошибкой: не тратим время на повторную попытку
+            retry_in = int(failure['expires'] - time.time()) + 1
+            await ctx.send(f"Трек недоступен ({failure['error']}), повторная попытка возможна через {retry_in} с: "
+                           f"{failure['message']}")
             return
+        track = Track(query)
+        track.video_id = video_id  # Если ID уже известен, resolve_track обойдётся без поиска
+        if await self.load_from_cache(track):
+            await self.enqueue(ctx, track)
+            return
+
+        track.resolve_task = self.bot.loop.create_task(self.resolve_track(ctx, track))
+        await self.enqueue(ctx, track)
+
+    async def load_from_cache(self, track):
+        """Если файл трека уже лежит в кэше, делает трек готовым без обращения к сети. Возвращает True при успехе."""
+        cached_file = self.cache.find_file(track.video_id) if track.video_id else None
+        if not cached_file:
+            return False
+        meta = self.cache.get_meta(track.video_id)
+        track.title = meta.get('title', track.title)
+        track.author = meta.get('author', track.author)
+        track.duration = meta.get('duration', track.duration)
+        if 'acodec' not in meta:
+            # Файл попал в кэш без метаданных: один раз определяем кодек и запоминаем его
+            meta['acodec'] = await self.probe_codec(cached_file)
+            self.cache.update_meta(track.video_id, acodec=meta['acodec'])
+        track.set_ready(cached_file, codec=meta['acodec'])
+        return True
+
+    async def load_playlist(self, ctx, url):
+        """Потоковая загрузка плейлиста.
 
-        if not query.startswith("http"):
-            query = f"ytsearch:{query}"
+        Плоское извлечение даёт только ID и названия, поэтому записи попадают в очередь
+        пачками по мере загрузки страниц плейлиста. Каждый трек разрешается лениво,
+        когда до него доходит планировщик предзагрузки.
+        """
+        self.ctx = self.ctx or ctx
+        task = asyncio.current_task()
+        added = 0
 
-        loop = asyncio.get_event_loop()
+        def on_entries(entries):
+            nonlocal added
+            if task not in self.playlist_tasks:
+                return  # Загрузку плейлиста отменили (stop), а пачка уже была в пути
+            tracks = [playlist_track(entry) for entry in entries if entry.get('id')]
+            if not added:
+                self.bot.loop.create_task(ctx.send(f"Плейлист: добавлено {len(tracks)} треков, загружаю остальные..."))
+            self.queue.extend(tracks)
+            added += len(tracks)
+            self.last_activity = time.monotonic()
+            self.schedule_prefetch()  # Запустит разрешение первых треков, если они в окне
 
         try:
-            with concurrent.futures.ThreadPoolExecutor() as pool:
-                data = await loop.run_in_executor(pool, lambda: ytdl.extract_info(query, download=True))
-            video = data['entries'][0] if 'entries' in data else data
-            filename = ytdl.prepare_filename(video)
-            source = discord.FFmpegPCMAudio(filename, executable=ffmpeg_executable, **ffmpeg_options)
-            source.title = video.get('title', 'Unnamed track')
-            source.author = video.get('uploader', 'Unknown author')
+            info = await self.extractor.extract_playlist(url, on_entries)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await ctx.send(f"Произошла ошибка при загрузке плейлиста: {str(e)}")
+            return
+        await ctx.send(f"Плейлист {info.get('title') or url} добавлен: {added} треков. "
+                       f"Всего треков в очереди: {len(self.queue)}")
+        if self.inactivity_task:
+            self.inactivity_task.cancel()
+            self.inactivity_task = None
 
-            self.queue.append(source)
-            await ctx.send(f"Трек добавлен в очередь: {source.author} - {source.title}")
+    def start_resolve(self, track):
+        """Запускает разрешение отложенного элемента плейлиста.
 
-            if not self.voice_client.is_playing():
-                await self.play_next(ctx)
+        Возвращает True, если элемент есть в отрицательном кэше и убран из очереди без разрешения.
+        """
+        if track.state != Track.PENDING or track.resolve_task is not None:
+            return False
+        if track.video_id and self.failures.get(track.video_id):
+            track.fail()
+            if track in self.queue:
+                self.queue.remove(track)
+            return True
+        track.resolve_task = self.bot.loop.create_task(self.resolve_track(self.ctx, track))
+        return False
 
-            await ctx.send(f"Всего треков в очереди: {len(self.queue)}")
+    async def add_many(self, ctx, queries):
+        """Пакетное добавление треков в очередь.
 
-            if self.inactivity_task:
-                self.inactivity_task.cancel()
-                self.inactivity_task = None
+        Все треки встают в очередь сразу и в исходном порядке, а разрешаются параллельно,
+        не больше BATCH_RESOLVE_LIMIT одновременно. Семафор пропускает задачи по порядку,
+        поэтому первый трек разрешается первым и начинает играть, не дожидаясь остальных.
+        """
+        self.last_activity = time.monotonic()
+        if not await self.join_channel(ctx):
+            return
+
+        semaphore = asyncio.Semaphore(BATCH_RESOLVE_LIMIT)
+        tracks = []
+        skipped = 0
+        for query in queries:
+            if os.path.isfile(query):
+                track = Track(query, title=os.path.basename(query))
+                track.set_ready(query)
+                tracks.append(track)
+                continue
+            if playlist_pattern.search(query):
+                await self.add_to_queue(ctx, query)  # Плейлист YouTube догружается в конец очереди
+                continue
+            video_id = lookup_video_id(query, self.searches)
+            if self.failures.get(*failure_keys(query, video_id)):
+                skipped += 1  # Недавно завершился ошибкой
+                continue
+            track = Track(query)
+            track.video_id = video_id
+            track.quiet = True
+            if not await self.load_from_cache(track):
+                track.resolve_task = self.bot.loop.create_task(self.resolve_limited(ctx, track, semaphore))
+            tracks.append(track)
+
+        self.queue.extend(tracks)
+        pending = sum(track.state == Track.PENDING for track in tracks)
+        message = f"Добавлено треков: {len(tracks)} (загружается {pending}). Всего треков в очереди: {len(self.queue)}"
+        if skipped:
+            message += f". Пропущено недоступных: {skipped}"
+        await ctx.send(message)
+
+        if not self.is_busy():
+            await self.play_next(ctx)
+        else:
+            await self.prepare_next()
+        self.schedule_prefetch()
+
+        if self.inactivity_task:
+            self.inactivity_task.cancel()
+            self.inactivity_task = None
+
+    async def resolve_limited(self, ctx, track, semaphore):
+        """resolve_track под семафором пакетной команды."""
+        async with semaphore:
+            await self.resolve_track(ctx, track)
+
+    async def create_playlist(self, ctx, name):
+        """Создание сохранённого плейлиста."""
+        if self.playlists.create(ctx.guild.id, name):
+            await ctx.send(f"Плейлист {name} успешно создан.")
+        else:
+            await ctx.send(f"Плейлист с именем {name} уже существует.")
+
+    async def add_to_playlist(self, ctx, name, query):
+        """Добавление запроса в сохранённый плейлист (разрешается при воспроизведении)."""
+        if self.playlists.add(ctx.guild.id, name, query):
+            await ctx.send(f"Трек {query} добавлен в плейлист {name}.")
+        else:
+            await ctx.send(f"Плейлист {name} не существует.")
+
+    async def play_playlist(self, ctx, name):
+        """Воспроизведение сохранённого плейлиста одной пакетной командой."""
+        queries = self.playlists.get(ctx.guild.id, name)
+        if queries is None:
+            await ctx.send(f"Плейлист {name} не существует.")
+            return
+        if not queries:
+            await ctx.send(f"Плейлист {name} пуст.")
+            return
+        await self.add_many(ctx, queries)
 
+    async def resolve_track(self, ctx, track):
+        """Фоновый поиск и получение ссылки (или загрузка) для трека из очереди."""
+        search = track.query if track.query.startswith("http") else f"ytsearch:{track.query}"
+
+        try:
+            if await self.load_from_cache(track):
+                return await self.track_resolved(ctx, track)
+            key = track.video_id
+            if not key and not track.query.startswith("http") and not STREAM_MODE:
+                # Загрузки объединяются по ID видео: сначала находим видео, потом качаем его по ссылке,
+                # чтобы поиск и прямая ссылка на то же видео не скачали файл дважды
+                video = first_entry(await self.extractor.extract_info(search, key=normalize_query(search)))
+                remember_track(track.query, video, self.searches)
+                track.video_id = key = video.get('id')
+                if await self.load_from_cache(track):
+                    return await self.track_resolved(ctx, track)
+            if key and not track.query.startswith("http"):
+                # Запрос уже искали: идём сразу к видео, без повторного поиска
+                search = f"https://www.youtube.com/watch?v={key}"
+            # Ссылки без распознанного ID различаются с учётом регистра, нормализуем только поиск
+            key = key or (search if search.startswith("http") else normalize_query(search))
+            if not STREAM_MODE and PROGRESSIVE_DOWNLOAD:
+                video, growing = await self.download_progressive(track, search, key)
+            else:
+                data = await self.extractor.extract_info(search, download=not STREAM_MODE, key=key)
+                video, growing = first_entry(data), None
+                if not STREAM_MODE:
+                    self.register_download(video)
+            remember_track(track.query, video, self.searches)
+            self.apply_video(track, video, growing)
+
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
+            if track.video_id and not track.query.startswith("http"):
+                self.searches.discard(normalize_query(track.query))  # Найденное раньше видео могло пропасть
+            self.failures.add(failure_keys(track.query, track.video_id), classify_error(e), str(e))
+            track.fail(e)
+            if track in self.queue:
+                self.queue.remove(track)
             await ctx.send(f"Произошла ошибка: {str(e)}")
 
+        else:
+            self.failures.discard(*failure_keys(track.query, track.video_id))
+            if not track.quiet:
+                await ctx.send(f"Трек загружен: {track.author} - {track.title}")
+            self.schedule_prefetch()
+
+        await self.track_resolved(ctx, track)
+
+    async def track_resolved(self, ctx, track):
+        """После разрешения трека: запуск воспроизведения или подготовка следующего трека."""
+        if self.is_busy():
+            await self.prepare_next()
+            return
+        if self.queue:
+            await self.play_next(ctx)
+        elif self.inactivity_task is None or self.inactivity_task.done():
+            self.inactivity_task = asyncio.create_task(self.disconnect_after_inactivity(ctx))
+
+    async def download_progressive(self, track, search, key):
+        """Загрузка, воспроизводить которую можно начать до её завершения.
+
+        Возвращает (данные видео, GrowingFile), как только yt-dlp начал писать файл,
+        или (данные видео, None), если загрузка успела завершиться раньше.
+        """
+        loop = asyncio.get_running_loop()
+        growing = GrowingFile()
+        started = loop.create_future()
+
+        def on_progress(status):
+            # Вызывается из потока пула загрузки
+            growing.on_progress(status)
+            if growing.is_open() and status.get('info_dict'):
+                loop.call_soon_threadsafe(lambda: started.done() or started.set_result(status['info_dict']))
+
+        download = asyncio.ensure_future(
+            self.extractor.extract_info(search, download=True, key=key, progress_hook=on_progress))
+        try:
+            await asyncio.wait({download, started}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            download.cancel()
+            growing.close()
+            raise
+
+        if download.done():
+            growing.close()
+            data = download.result()
+            video = first_entry(data)
+            self.register_download(video)
+            return video, None
+
+        track.download_task = self.bot.loop.create_task(self.finish_progressive(download, growing))
+        return started.result(), growing
+
+    async def finish_progressive(self, download, growing):
+        """Дожидается конца загрузки, начатой download_progressive, и кладёт файл в кэш."""
+        failed = True
+        try:
+            data = await download
+            self.register_download(first_entry(data))
+            failed = False
+        except asyncio.CancelledError:
+            download.cancel()
+            raise
+        except Exception as e:
+            print(f"Ошибка загрузки воспроизводимого трека: {str(e)}", flush=True)
+        finally:
+            growing.finish(failed)
+
+    async def overlay(self, ctx, path):
+        """Накладывает звук поверх играющего трека, не прерывая его.
+
+        Если ничего не играет, звук просто ставится в очередь как обычный трек.
+        """
+        self.last_activity = time.monotonic()
+        if self.mixer is None or not self.is_busy():
+            await self.add_to_queue(ctx, path)
+            return
+        try:
+            clip = await self.load_clip(path)
+        except Exception as e:
+            await ctx.send(f"Произошла ошибка: {str(e)}")
+            return
+        self.mixer.add_overlay(clip)
+
+    async def load_clip(self, path):
+        """Возвращает звук в PCM из памяти, при первом обращении декодируя его в потоке."""
+        clip = self.clips.get(path)
+        if clip is None:
+            clip = await asyncio.get_event_loop().run_in_executor(
+                None, load_pcm_clip, path, ffmpeg_executable, OVERLAY_MAX_SECONDS)
+            self.clips[path] = clip
+        return clip
+
+    async def enqueue(self, ctx, track):
+        """Постановка трека в очередь и запуск воспроизведения, если ничего не играет."""
+        self.queue.append(track)
+        if track.state == Track.READY:
+            await ctx.send(f"Трек добавлен в очередь: {track.author} - {track.title}")
+        else:
+            await ctx.send(f"Трек добавлен в очередь (загружается): {track.title}")
+
+        if not self.is_busy():
+            await self.play_next(ctx)
+        else:
+            await self.prepare_next()
+
+        await ctx.send(f"Всего треков в очереди: {len(self.queue)}")
+        self.schedule_prefetch()
+
+        if self.inactivity_task:
+            self.inactivity_task.cancel()
+            self.inactivity_task = None
+
+    def apply_video(self, track, video, growing=None):
+        """Заполняет трек данными из yt-dlp: файл в кэше, загружаемый файл или прямая ссылка на поток."""
+        track.title = video.get('title', 'Unnamed track')
+        track.author = video.get('uploader', 'Unknown author')
+        track.video_id = video.get('id')
+        track.webpage_url = video.get('webpage_url') or video.get('original_url')
+        track.duration = video.get('duration')
+
+        filename = ytdl.prepare_filename(video)
+        if os.path.isfile(filename):
+            track.set_ready(filename, codec=video.get('acodec'))
+        elif growing is not None:
+            track.set_ready(growing, codec=video.get('acodec'), progressive=True)
+        elif STREAM_MODE:
+            track.set_ready(video['url'], stream=True, http_headers=video.get('http_headers', {}),
+                            codec=video.get('acodec'))
+        else:
+            raise FileNotFoundError(f"Файл {filename} не найден после загрузки")
+
+    def create_source(self, track):
+        """Создание источника звука: из памяти, из файла кэша или напрямую по URL потока.
+
+        Opus-источники (почти все webm с YouTube) передаются в Discord без перекодирования:
+        FFmpeg только перепаковывает пакеты (-c:a copy), а discord.py не кодирует PCM в Opus.
+        Горячие треки играются из памяти, а треки библиотеки с файлом пакетов — из mmap,
+        в обоих случаях вообще без FFmpeg. Остальные треки, одновременно играющие
+        на нескольких серверах, читают кадры одного общего процесса FFmpeg.
+        """
+        key = track.frame_key()
+        if not self.crossfade_frames:
+            frames = self.frames.get(key)
+            if frames is not None:
+                return OpusFramesSource(frames)
+            packet_source = self.open_packet_file(track)
+            if packet_source is not None:
+                return packet_source
+
+        if key is None:
+            return self.create_ffmpeg_source(track)
+        use_opus = track.codec == 'opus' and not self.crossfade_frames
+        return self.decoders.subscribe((key, use_opus), lambda start: self.create_ffmpeg_source(track, start))
+
+    def create_ffmpeg_source(self, track, start=0):
+        """Источник через FFmpeg; start — позиция начала в секундах."""
+        if track.progressive and track.location.done:
+            self.refresh_location(track)  # Загрузка уже завершилась: читаем файл из кэша
+        if track.stream:
+            # yt-dlp требует передавать свои заголовки при запросе прямой ссылки
+            headers = ''.join(f"{key}: {value}\r\n" for key, value in track.http_headers.items())
+            before_options = ffmpeg_stream_options['before_options']
+            if headers:
+                before_options += f' -headers "{headers}"'
+            options = {'before_options': before_options, 'options': ffmpeg_stream_options['options']}
+        else:
+            options = ffmpeg_options
+
+        if start:
+            options = {**options, 'before_options': f"{options['before_options']} -ss {start:.2f}"}
+
+        location = track.location
+        if track.progressive:
+            # Файл ещё загружается: FFmpeg читает его через stdin и ждёт новых данных
+            location = track.location.reader()
+            options = {**options, 'pipe': True}
+
+        if track.codec == 'opus' and not self.crossfade_frames:
+            # codec='opus' заставляет discord.py запустить FFmpeg с -c:a copy
+            source = discord.FFmpegOpusAudio(location, codec='opus', executable=ffmpeg_executable, **options)
+        else:
+            source = discord.FFmpegPCMAudio(location, executable=ffmpeg_executable, **options)
+        if track.progressive:
+            source = PipedSource(source, location)  # Дескриптор читателя закрывается вместе с FFmpeg
+        return source
+
+    def open_packet_file(self, track):
+        """Источник из файла пакетов трека кэша, если он построен. Иначе None."""
+        if not track.video_id or track.stream or track.progressive:
+            return None
+        packet_file = self.cache.get_meta(track.video_id).get('packet_file')
+        if not packet_file:
+            return None
+        try:
+            return PacketFileSource(PacketFile(packet_file))
+        except (OSError, ValueError) as e:
+            print(f"Не удалось открыть файл пакетов {packet_file}: {str(e)}", flush=True)
+            return None
+
+    async def probe_codec(self, path):
+        """Определяет аудиокодек файла через ffprobe. Возвращает имя кодека или None."""
+        try:
+            return await asyncio.get_event_loop().run_in_executor(None, probe_codec, ffmpeg_executable, path)
+        except Exception as e:
+            print(f"Не удалось определить кодек {path}: {str(e)}", flush=True)
+            return None
+
+    def count_play(self, track):
+        """Учитывает воспроизведение трека и загружает его в память, если он стал горячим."""
+        if track.video_id:
+            self.cache.record_play(track.video_id)
+        key = track.frame_key()
+        if key is None:
+            return
+        self.frames.record_play(key)
+        if not self.frames.wants(key):
+            return
+        if track.video_id:
+            # Треки кэша берём только после конвертации: громкость уже выровнена, пакеты копируются как есть
+            entry = self.cache.cache.get(track.video_id)
+            path = entry['path'] if entry and entry['meta'].get('normalized') else None
+        else:
+            path = track.location
+        if path:
+            self.frames.load(key, lambda: load_opus_frames(path, ffmpeg_executable, INGEST_BITRATE_KBPS))
+
+    def register_download(self, video):
+        """Регистрирует загруженный файл в LRU-кэше (с соблюдением лимита размера)."""
+        filename = ytdl.prepare_filename(video)
+        if video.get('id') and os.path.isfile(filename):
+            self.cache.add_to_cache(video['id'], filename,
+                                    title=video.get('title', 'Unnamed track'),
+                                    author=video.get('uploader', 'Unknown author'),
+                                    acodec=video.get('acodec'),
+                                    duration=video.get('duration'))
+            self.ingest.submit(video['id'])
+
+    def refresh_location(self, track):
+        """Перед запуском трека берёт актуальный файл из кэша.
+
+        Файл мог появиться после разрешения трека (предзагрузка или завершение
+        загрузки, начатой с воспроизведением) или смениться после конвертации в Ogg/Opus.
+        """
+        if not track.video_id or (not track.stream and not track.progressive and os.path.isfile(track.location)):
+            return
+        path = self.cache.find_file(track.video_id)
+        if path:
+            track.set_ready(path, codec=self.cache.get_meta(track.video_id).get('acodec'))
+
+    def schedule_prefetch(self):
+        """Планировщик предзагрузки: держит в кэше следующие PREFETCH_DEPTH треков очереди.
+
+        Предзагрузка треков, которые ушли из окна (пропущены или удалены), отменяется.
+        Текущий трек, играющий по прямой ссылке, тоже докачивается, если включён CACHE_IN_BACKGROUND.
+        """
+        window = self.queue[:PREFETCH_DEPTH]
+        if CACHE_IN_BACKGROUND and self.current is not None:
+            window.append(self.current)
+
+        for track, task in list(self.prefetch_tasks.items()):
+            if track not in window:
+                task.cancel()
+                del self.prefetch_tasks[track]
+
+        dropped = False
+        for track in window:
+            if track.lazy and track is not self.current and self.start_resolve(track):
+                dropped = True
+                continue
+            if track in self.prefetch_tasks or track.state != Track.READY:
+                continue
+            if not track.stream or not track.video_id or not track.webpage_url:
+                continue  # Уже в кэше или загружать нечего
+            if self.failures.get(track.video_id):
+                continue  # Видео недавно не удалось получить
+            self.prefetch_tasks[track] = self.bot.loop.create_task(self.prefetch(track))
+
+        if dropped:
+            self.schedule_prefetch()  # Убранные элементы освободили место в окне
+
+    async def prefetch(self, track):
+        """Фоновая загрузка трека в кэш с низким приоритетом."""
+        try:
+            if not self.cache.find_file(track.video_id):
+                data = await self.extractor.extract_info(track.webpage_url, download=True, key=track.video_id,
+                                                         priority=PRIORITY_LOW)
+                self.register_download(data)
+                print(f"Трек {track.video_id} сохранён в кэш.", flush=True)
+            if track is not self.current:
+                self.refresh_location(track)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Ошибка предзагрузки {track.webpage_url}: {str(e)}", flush=True)
+        finally:
+            if self.prefetch_tasks.get(track) is asyncio.current_task():
+                del self.prefetch_tasks[track]
 
     async def skip(self, ctx):
         """Пропуск текущего трека."""
         async with self.lock:
-            if not self.voice_client or not self.voice_client.is_playing():
+            if not self.is_busy():
                 await ctx.send("Нет трека для пропуска.")
                 return
 
+            if self.current:
+                self.current.cancel()  # Загрузку трека, который никто не дослушает, прерываем
+                prefetch = self.prefetch_tasks.pop(self.current, None)
+                if prefetch is not None:
+                    prefetch.cancel()  # И фоновую докачку в кэш тоже
+
+            if self.voice_client.is_playing() and self.output and (self.prepared or self.output.fade):
+                # Следующий трек уже подготовлен: GaplessSource переключится на него на следующем кадре
+                self.output.skip_requested = True
+                await ctx.send("Текущий трек пропущен.")
+                return
+
             self.voice_client.stop()
             await ctx.send(f"Текущий трек пропущен. Осталось треков в очереди: {len(self.queue)}")
 
 
+    async def remove(self, ctx, position):
+        """Удаление трека из очереди по номеру (с 1). Его поиск и загрузка прерываются."""
+        async with self.lock:
+            if not 1 <= position <= len(self.queue):
+                await ctx.send(f"В очереди нет трека с номером {position}.")
+                return
+            track = self.queue.pop(position - 1)
+            track.cancel()
+            if position == 1:
+                self.discard_prepared()
+            self.schedule_prefetch()
+            await ctx.send(f"Трек удалён из очереди: {track.title}")
+
+        if self.queue and not self.is_busy():
+            await self.play_next(ctx)
+        else:
+            await self.prepare_next()
+
+    async def pause(self, ctx):
+        """Пауза текущего трека."""
+        if not self.voice_client or not self.voice_client.is_playing():
+            await ctx.send("Сейчас ничего не играет.")
+            return
+        self.voice_client.pause()
+        await ctx.send("Воспроизведение приостановлено.")
+
+    async def resume(self, ctx):
+        """Продолжение воспроизведения после паузы."""
+        if not self.voice_client or not self.voice_client.is_paused():
+            await ctx.send("Воспроизведение не на паузе.")
+            return
+        self.voice_client.resume()
+        await ctx.send("Воспроизведение продолжено.")
+
     async def stop(self, ctx):
         """Остановка воспроизведения и очистка очереди."""
         async with self.lock:
-            if self.voice_client and self.voice_client.is_playing():
+            if self.is_busy():
                 self.voice_client.stop()
+            for task in self.playlist_tasks:
+                task.cancel()
+            self.playlist_tasks.clear()
+            for track in [self.current, *self.queue]:
+                if track:
+                    track.cancel()
             self.queue.clear()
+            self.current = None
+            self.schedule_prefetch()
             await self.disconnect_from_channel()
             await ctx.send("Воспроизведение остановлено и очередь очищена.")
 
     async def disconnect_from_channel(self):
         """Отключение бота от голосового канала."""
+        self.discard_prepared()
+        self.output = None
+        self.mixer = None
         if self.voice_client:
             await self.voice_client.disconnect()
         self.voice_client = None
@@ -160,9 +1011,92 @@ class MusicPlayer():
     async def disconnect_after_inactivity(self, ctx):
         """Отключение через минуту, если ничего не играет."""
         await asyncio.sleep(60)
-        if not self.voice_client.is_playing() and len(self.queue) == 0:
+        if self.voice_client and not self.is_busy() and len(self.queue) == 0:
             await ctx.send("Ничего не воспроизводится в течение минуты. Покидаю канал.")
             await self.disconnect_from_channel()
 
+
+class PlayerRegistry:
+    """Реестр плееров: по одному MusicPlayer на сервер с общим кэшем.
+
+    Плееры создаются лениво при первой команде на сервере и освобождаются,
+    если простаивают дольше idle_timeout секунд.
+    """
+    def __init__(self, bot, idle_timeout=600, reap_interval=60):
+        self.bot = bot
+        self.players = {}  # guild ID -> MusicPlayer
+        self.cache = LRUCache('cache', max_size_gb=5)  # Общий для всех серверов кэш
+        self.extractor = ExtractorPool(ytdl_format_options, max_workers=EXTRACTOR_WORKERS)
+        self.ingest = IngestPool(self.cache, ffmpeg_executable, max_workers=INGEST_WORKERS,
+                                 bitrate_kbps=INGEST_BITRATE_KBPS, target_lufs=LOUDNESS_TARGET_LUFS)
+        self.ingest.backfill()  # Доводим до единого формата всё, что скачано раньше
+        self.frames = FrameCache(FRAME_CACHE_MB * 1024 * 1024, min_plays=FRAME_CACHE_MIN_PLAYS)
+        self.warm_frames()
+        self.decoders = DecoderHub(int(FANOUT_WINDOW_SECONDS / FRAME_DURATION))
+        self.clips = {}  # путь -> PCM-клип для наложения (общий для всех серверов)
+        self.searches = SearchCache('cache', ttl=SEARCH_CACHE_TTL_DAYS * 24 * 3600)
+        self.failures = NegativeCache(NEGATIVE_CACHE_TTLS)  # Общий: недоступное видео недоступно на всех серверах
+        self.playlists = PlaylistStore('cache')
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self.reaper_task = bot.loop.create_task(self.reap_idle_players())
+
+    def get(self, guild):
+        """Возвращает плеер сервера, создавая его при необходимости."""
+        player = self.players.get(guild.id)
+        if player is None:
+            player = MusicPlayer(self.bot, guild.voice_client, cache=self.cache, extractor=self.extractor,
+                                 ingest=self.ingest, frames=self.frames, decoders=self.decoders, clips=self.clips,
+                                 searches=self.searches, failures=self.failures, playlists=self.playlists)
+            self.players[guild.id] = player
+        return player
+
+    def warm_frames(self):
+        """Загружает в память самые популярные треки кэша, уже приведённые к Ogg/Opus."""
+        top = sorted(self.cache.cache.items(), key=lambda item: item[1]['hits'], reverse=True)
+        for video_id, entry in top[:FRAME_CACHE_WARM_TRACKS]:
+            if entry['hits'] < FRAME_CACHE_MIN_PLAYS or not entry['meta'].get('normalized'):
+                continue
+            self.preload(video_id, entry['path'], plays=entry['hits'])
+
+    def preload(self, key, path, plays=None):
+        """Загружает трек в память независимо от числа воспроизведений (например, звуки мем-команд).
+
+        plays — известное число воспроизведений трека, с которого начинается его счётчик;
+        по умолчанию порог загрузки min_plays.
+        """
+        self.frames.record_play(key, self.frames.min_plays if plays is None else plays)
+        self.frames.load(key, lambda: load_opus_frames(path, ffmpeg_executable, INGEST_BITRATE_KBPS))
+
+    async def preload_clip(self, path):
+        """Заранее декодирует звук для наложения поверх треков."""
+        try:
+            self.clips[path] = await self.bot.loop.run_in_executor(
+                None, load_pcm_clip, path, ffmpeg_executable, OVERLAY_MAX_SECONDS)
+        except Exception as e:
+            print(f"Не удалось декодировать звук {path}: {str(e)}", flush=True)
+
+    async def reap_idle_players(self):
+        """Периодически освобождает плееры серверов, где бот давно ничего не делает."""
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            now = time.monotonic()
+            for guild_id, player in list(self.players.items()):
+                if player.is_idle() and now - player.last_activity > self.idle_timeout:
+                    if player.inactivity_task:
+                        player.inactivity_task.cancel()
+                    del self.players[guild_id]
+                    print(f"Плеер сервера {guild_id} освобождён за простоем. Активных плееров: {len(self.players)}",
+                          flush=True)
+
+    def close(self):
+        """Останавливает фоновые задачи реестра."""
+        self.reaper_task.cancel()
+        self.extractor.shutdown()
+        self.ingest.shutdown()
+        self.frames.shutdown()
+        self.searches.flush()
+
+
 def setup(bot):
     bot.add_cog(MusicPlayer(bot))
@@ -0,0 +1,195 @@
+import os
+import sys
+import mmap
+import struct
+import subprocess
+from array import array
+
+# Discord принимает ровно один Opus-пакет на каждые 20 мс
+FRAME_MS = 20
+
+OGG_PAGE_HEADER = struct.Struct('<4sBBqIIIB')  # capture, версия, флаги, granule, serial, номер, CRC, число сегментов
+
+# Файл пакетов: заголовок, индекс смещений (число кадров + 1, uint32 LE) и Opus-пакеты подряд
+PACKET_FILE_EXTENSION = 'opk'
+PACKET_FILE_MAGIC = b'OPKT'
+PACKET_FILE_VERSION = 1
+PACKET_FILE_HEADER = struct.Struct('<4sB3xI')  # сигнатура, версия, число кадров
+
+# Длительность кадра (в десятых долях мс) по конфигурации TOC-байта Opus (RFC 6716, 3.1)
+_FRAME_TENTHS_MS = [100, 200, 400, 600] * 3 + [100, 200] * 2 + [25, 50, 100, 200] * 4
+
+
+class OpusFrames:
+    """Трек в виде Opus-пакетов, уложенных подряд в одном буфере, и индекса их смещений.
+
+    Пакет i занимает data[offsets[i]:offsets[i + 1]].
+    """
+    __slots__ = ('data', 'offsets')
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def packet(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]]
+
+    @property
+    def size(self):
+        """Занимаемая память в байтах."""
+        return len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+
+def iter_ogg_packets(data):
+    """Разбирает Ogg-контейнер и возвращает пакеты первого логического потока."""
+    position = 0
+    serial = None
+    packet = bytearray()
+    while position < len(data):
+        capture, _, _, _, page_serial, _, _, segments = OGG_PAGE_HEADER.unpack_from(data, position)
+        if capture != b'OggS':
+            raise ValueError(f"Повреждённая Ogg-страница на смещении {position}")
+        table_start = position + OGG_PAGE_HEADER.size
+        body = table_start + segments
+        position = body + sum(data[table_start:body])
+        if serial is None:
+            serial = page_serial
+        elif page_serial != serial:
+            continue
+
+        for lacing in data[table_start:body]:
+            packet += data[body:body + lacing]
+            body += lacing
+            if lacing < 255:
+                yield bytes(packet)
+                packet.clear()
+
+
+def packet_duration_ms(packet):
+    """Длительность Opus-пакета в мс по его TOC-байту."""
+    toc = packet[0]
+    frame = _FRAME_TENTHS_MS[toc >> 3]
+    code = toc & 0x03
+    if code == 0:
+        count = 1
+    elif code in (1, 2):
+        count = 2
+    else:
+        count = packet[1] & 0x3F
+    return frame * count / 10
+
+
+def parse_ogg_opus(data):
+    """Достаёт Opus-пакеты из файла Ogg/Opus. Все пакеты должны быть по 20 мс."""
+    packets = iter_ogg_packets(data)
+    if not next(packets, b'').startswith(b'OpusHead'):
+        raise ValueError("Ogg-поток не содержит Opus")
+    next(packets, None)  # OpusTags
+
+    buffer = bytearray()
+    offsets = array('I', [0])
+    for packet in packets:
+        if not packet:
+            continue
+        if packet_duration_ms(packet) != FRAME_MS:
+            raise ValueError(f"Opus-пакет длительностью {packet_duration_ms(packet)} мс вместо {FRAME_MS} мс")
+        buffer += packet
+        offsets.append(len(buffer))
+    return OpusFrames(bytes(buffer), offsets)
+
+
+def encode_ogg_opus(ffmpeg_executable, path, bitrate_kbps=128):
+    """Кодирует файл в Ogg/Opus с 20-мс кадрами (в память) и возвращает его содержимое."""
+    result = subprocess.run([ffmpeg_executable, '-nostdin', '-hide_banner', '-loglevel', 'error', '-i', path,
+                             '-vn', '-map_metadata', '-1', '-c:a', 'libopus', '-b:a', f'{bitrate_kbps}k',
+                             '-frame_duration', str(FRAME_MS), '-ar', '48000', '-ac', '2', '-f', 'ogg', '-'],
+                            check=True, stdin=subprocess.DEVNULL, capture_output=True)
+    return result.stdout
+
+
+def load_opus_frames(path, ffmpeg_executable, bitrate_kbps=128):
+    """Загружает трек как набор Opus-пакетов.
+
+    Файлы Ogg/Opus с 20-мс кадрами (библиотека кэша после конвертации) разбираются
+    напрямую, остальные один раз кодируются FFmpeg.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.startswith(b'OggS'):
+        try:
+            return parse_ogg_opus(data)
+        except ValueError:
+            pass  # Не Opus или другая длительность кадров: перекодируем
+    return parse_ogg_opus(encode_ogg_opus(ffmpeg_executable, path, bitrate_kbps))
+
+
+class PacketFile:
+    """Файл пакетов, отображённый в память (mmap).
+
+    Интерфейс тот же, что у OpusFrames, но packet() возвращает memoryview
+    прямо на страницы файла, без копирования. Индекс и пакеты читаются по требованию,
+    а страницы файла разделяются всеми процессами и источниками, играющими этот трек.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mmap) < PACKET_FILE_HEADER.size:
+            self.mmap.close()
+            raise ValueError(f"Файл пакетов {path} обрезан")
+        magic, version, count = PACKET_FILE_HEADER.unpack_from(self.mmap)
+        if magic != PACKET_FILE_MAGIC or version != PACKET_FILE_VERSION:
+            self.mmap.close()
+            raise ValueError(f"{path} не является файлом пакетов версии {PACKET_FILE_VERSION}")
+        index_end = PACKET_FILE_HEADER.size + 4 * (count + 1)
+        # Индекс должен помещаться в файл, а последнее смещение — совпадать с объёмом пакетов
+        if (index_end > len(self.mmap)
+                or struct.unpack_from('<I', self.mmap, index_end - 4)[0] != len(self.mmap) - index_end):
+            self.mmap.close()
+            raise ValueError(f"Файл пакетов {path} обрезан или повреждён")
+        self.view = memoryview(self.mmap)
+        if sys.byteorder == 'little':
+            self.offsets = self.view[PACKET_FILE_HEADER.size:index_end].cast('I')
+        else:
+            self.offsets = array('I', self.view[PACKET_FILE_HEADER.size:index_end])
+            self.offsets.byteswap()
+        self.data = self.view[index_end:]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def packet(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]]
+
+    @property
+    def size(self):
+        return len(self.mmap)
+
+    def close(self):
+        """Освобождает отображение. Если пакеты ещё где-то используются, его закроет сборщик мусора."""
+        for view in (self.data, self.offsets, self.view):
+            if isinstance(view, memoryview):
+                view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass
+
+
+def write_packet_file(path, frames):
+    """Атомарно записывает OpusFrames в файл пакетов."""
+    offsets = array('I', frames.offsets)
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    temp_path = path + '.part'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(PACKET_FILE_HEADER.pack(PACKET_FILE_MAGIC, PACKET_FILE_VERSION, len(frames)))
+            f.write(offsets.tobytes())
+            f.write(frames.data)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)